@@ -0,0 +1,44 @@
+# Microbenchmark: per-point haversine loop vs. the vectorized PointSet query
+# Run from the backend directory: python benchmarks/bench_distance.py
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from geo import PointSet, haversine
+
+LAT, LNG = 42.3601, -71.0589  # Boston
+RADIUS = 5000  # meters
+REPEAT = 5
+
+
+def loop_filter(coordinates, lat, lng, radius):
+    # the previous approach: one Python-level distance call per point
+    return [i for i, (plat, plng) in enumerate(coordinates) if haversine(lat, lng, plat, plng) <= radius]
+
+
+def best_time(fn):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    random.seed(0)
+    for n in (10_000, 100_000):
+        coordinates = [(LAT + random.uniform(-0.5, 0.5), LNG + random.uniform(-0.5, 0.5)) for _ in range(n)]
+        points = PointSet.from_coordinates([[c] for c in coordinates])
+
+        loop = best_time(lambda: loop_filter(coordinates, LAT, LNG, RADIUS))
+        vectorized = best_time(lambda: points.within(LAT, LNG, RADIUS))
+        assert sorted(points.within(LAT, LNG, RADIUS)[0]) == loop_filter(coordinates, LAT, LNG, RADIUS)
+        print(f"{n:>7} points  loop {loop * 1000:8.2f} ms  vectorized {vectorized * 1000:7.2f} ms  speedup {loop / vectorized:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
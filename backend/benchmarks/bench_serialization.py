@@ -0,0 +1,92 @@
+# Microbenchmark: pydantic ServiceModel + response_model validation vs. the trusted-record encoder
+# Run from the backend directory: python benchmarks/bench_serialization.py
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from models import ServiceModel
+from serialize import dumps, service_record
+from service import Service
+
+SERVICE_TYPES = ["Education", "Legal", "Housing/Shelter", "Healthcare", "Food", "Employment"]
+REPEAT = 5
+
+
+def sheet_service(rng, i):
+    # shaped like spreadsheet.parse_row output: hashed int ID, comma-separated strings, googlelink False
+    return Service(
+        ID=rng.getrandbits(60), name=f"Organization {i}", servicetype=", ".join(rng.sample(SERVICE_TYPES, 2)),
+        extrafilters="Free, Walk-in", demographic="any status", website=f"https://example.org/org{i}",
+        summary="Fake organization for benchmarks", address=[f"{i} Main St, Boston, MA"],
+        coordinates=[(42.36 + rng.uniform(-0.1, 0.1), -71.05 + rng.uniform(-0.1, 0.1))], neighborhoods="Downtown",
+        hours="9-5", phone=6175550199, languages="English, Arabic", googlelink=False, source="Urban Refuge Aid"
+    )
+
+
+def places_service(rng, i):
+    # shaped like map.map_to_service output
+    return Service(
+        ID=str(rng.getrandbits(60)), name=f"Place {i}", servicetype=["Food"], extrafilters=None, demographic=None,
+        website=f"https://example.com/{i}", summary=None, address=[f"{i} Elm St, Boston, MA 02108, USA"],
+        coordinates=[(42.36 + rng.uniform(-0.1, 0.1), -71.05 + rng.uniform(-0.1, 0.1))], neighborhoods=None,
+        hours=None, phone="(617) 555-0100", languages=["English"], googlelink=f"https://maps.google.com/?cid={i}",
+        source="Google Maps API"
+    )
+
+
+def model_path(services, field):
+    # the previous approach: build a ServiceModel per service, then let FastAPI re-validate and encode
+    models = [
+        ServiceModel(
+            servicetype=[service.servicetype] if isinstance(service.servicetype, str) else service.servicetype,
+            extrafilters=service.extrafilters.split(', ') if isinstance(service.extrafilters, str) else (service.extrafilters or []),
+            languages=[service.languages] if isinstance(service.languages, str) else (service.languages or []),
+            googlelink=str(service.googlelink) if isinstance(service.googlelink, bool) else service.googlelink,
+            upvote=3,
+            **{k: v for k, v in service.to_dict().items() if k not in {'servicetype', 'extrafilters', 'languages', 'googlelink', 'upvote'}}
+        )
+        for service in services
+    ]
+    content = asyncio.run(serialize_response(field=field, response_content=models))
+    return JSONResponse(content).body
+
+
+def record_path(services):
+    return dumps([service_record(service, 3) for service in services])
+
+
+def best_time(fn):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    rng = random.Random(0)
+    field = create_response_field(name="Response_get_combined_services", type_=List[ServiceModel])
+    for n in (100, 1000, 5000):
+        services = [sheet_service(rng, i) if i % 2 else places_service(rng, i) for i in range(n)]
+        # both paths must produce the same JSON document
+        assert json.loads(model_path(services, field)) == json.loads(record_path(services))
+
+        model = best_time(lambda: model_path(services, field))
+        record = best_time(lambda: record_path(services))
+        print(f"{n:>5} services  pydantic {model / n * 1e6:7.2f} us/service  records {record / n * 1e6:6.2f} us/service"
+              f"  speedup {model / record:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
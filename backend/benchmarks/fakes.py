@@ -0,0 +1,179 @@
+# Local stand-ins for Google Places, Geocoding and gspread, used by the benchmark harness
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CENTER = (42.3601, -71.0589)  # Boston
+SERVICE_TYPES = ["Education", "Legal", "Housing/Shelter", "Healthcare", "Food", "Employment",
+                 "Community Education", "Cash Assistance", "Mental Health Services", "Case Management"]
+
+
+def _stable_offset(text, spread=0.1):
+    # deterministic point near CENTER for a given string
+    digest = hashlib.sha256(text.encode()).digest()
+    return (CENTER[0] + (digest[0] / 255 - 0.5) * spread,
+            CENTER[1] + (digest[1] / 255 - 0.5) * spread)
+
+
+class FakeGoogleConfig:
+    """
+    Behaviour of the fake Google Maps server.
+
+    Args:
+        latency (float): Seconds each request waits before answering.
+        results (int): Text search results per query.
+        place_pool (int): Number of distinct places searches draw from, so keywords overlap.
+        error_rate (float): Fraction of requests answered with HTTP 500.
+    """
+
+    def __init__(self, latency=0.05, results=20, place_pool=200, error_rate=0.0):
+        self.latency = latency
+        self.results = results
+        self.place_pool = place_pool
+        self.error_rate = error_rate
+        self.calls = {"textsearch": 0, "details": 0, "geocode": 0}
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        kind = url.path.rstrip("/").split("/")[-2]
+        with config.lock:
+            config.calls[kind] = config.calls.get(kind, 0) + 1
+        time.sleep(config.latency)
+
+        if random.random() < config.error_rate:
+            return self._send(500, {"status": "UNKNOWN_ERROR"})
+        if kind == "textsearch":
+            seed = int(hashlib.sha256(params.get("query", "").encode()).hexdigest(), 16)
+            ids = [f"place-{(seed + i * 7) % config.place_pool}" for i in range(config.results)]
+            return self._send(200, {"status": "OK", "results": [{"place_id": place_id} for place_id in ids]})
+        if kind == "details":
+            place_id = params.get("place_id", "")
+            lat, lng = _stable_offset(place_id)
+            number = place_id.split("-")[-1]
+            return self._send(200, {"status": "OK", "result": {
+                "name": f"Fake Place {number}",
+                "formatted_address": f"{number} Fake St, Boston, MA",
+                "geometry": {"location": {"lat": lat, "lng": lng}},
+                "website": f"https://example.org/{number}",
+                "formatted_phone_number": "(617) 555-0100",
+                "editorial_summary": {"overview": "A fake place for benchmarks"},
+                "url": f"https://maps.google.com/?cid={number}",
+            }})
+        if kind == "geocode":
+            lat, lng = _stable_offset(params.get("address", ""))
+            return self._send(200, {"status": "OK", "results": [{"geometry": {"location": {"lat": lat, "lng": lng}}}]})
+        self._send(404, {"status": "NOT_FOUND"})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGoogleServer:
+    """
+    Threaded HTTP server answering the Places text search, Place details and Geocoding endpoints.
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or FakeGoogleConfig()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.config = self.config
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def fake_sheet_rows(count, seed=0):
+    """
+    Generates sheet rows shaped like the UrbanRefugeAidServices form responses.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        addresses = [f"{i} Main St, Boston, MA"] + ([f"{i} Second Ave, Boston, MA"] if i % 5 == 0 else [])
+        rows.append({
+            "Name of Organization": f"Organization {i}",
+            "Address": ";".join(addresses),
+            "Service Type": ", ".join(rng.sample(SERVICE_TYPES, rng.randint(1, 3))),
+            "Extra Filters": "",
+            "Who are these services for? (refugees, asylees, TPS, parolees, any status, etc.)": "any status",
+            "Website": f"https://example.org/org{i}",
+            "Summary of Services": "Fake organization for benchmarks",
+            "Neighborhood": "Downtown",
+            "Hours": "9-5",
+            "Phone Number (for public to contact)": "(617) 555-0199",
+            "Services offered in these languages": "English, Arabic",
+        })
+    return rows
+
+
+class FakeWorksheet:
+    def __init__(self, rows, latency, error_rate):
+        self.rows = rows
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    def get_all_records(self):
+        self.calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise RuntimeError("fake sheet error")
+        return [dict(row) for row in self.rows]
+
+
+class FakeSpreadsheet:
+    def __init__(self, rows, latency, error_rate):
+        self.sheet1 = FakeWorksheet(rows, latency, error_rate)
+        self.revision = "1"
+
+    def get_lastUpdateTime(self):
+        return self.revision
+
+
+class FakeGspreadClient:
+    """
+    Stands in for an authorized gspread client; open() returns the same fake spreadsheet for any name.
+
+    Args:
+        rows (int): Number of generated sheet rows.
+        latency (float): Seconds each get_all_records call takes.
+        error_rate (float): Fraction of get_all_records calls that raise.
+    """
+
+    def __init__(self, rows=200, latency=0.5, error_rate=0.0):
+        self.spreadsheet = FakeSpreadsheet(fake_sheet_rows(rows), latency, error_rate)
+
+    def open(self, name):
+        return self.spreadsheet
@@ -0,0 +1,249 @@
+# Offline benchmark harness: runs the FastAPI app against local fakes of Google Sheets, Geocoding and Places
+#
+#   python benchmarks/run.py                      # defaults, results saved under benchmarks/results/
+#   python benchmarks/run.py --latency 0.2 --error-rate 0.05 --concurrency 64
+#   python benchmarks/run.py --compare benchmarks/results/<older commit>.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import httpx
+import uvicorn
+from fakes import CENTER, SERVICE_TYPES, FakeGoogleConfig, FakeGoogleServer, FakeGspreadClient
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Google Maps latency per call (s)")
+    parser.add_argument("--sheet-latency", type=float, default=0.5, help="fake get_all_records latency (s)")
+    parser.add_argument("--results", type=int, default=20, help="Places results per text search")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--sheet-rows", type=int, default=200, help="rows in the fake sheet")
+    parser.add_argument("--locations", type=int, default=5000, help="user-submitted locations seeded into services.db")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--output", help="where to write results (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet"], cwd=BACKEND_DIR) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed_locations(count):
+    from database import insert_service, pooled_connection
+    from models import ServiceModel
+
+    rng = random.Random(1)
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        for i in range(count):
+            insert_service(cursor, ServiceModel(
+                ID=f"bench-{i}", name=f"Bench Location {i}",
+                servicetype=rng.sample(SERVICE_TYPES, 2), extrafilters=None,
+                address=[f"{i} Bench St"], languages=["English"],
+                coordinates=(CENTER[0] + rng.uniform(-0.3, 0.3), CENTER[1] + rng.uniform(-0.3, 0.3)),
+                source="User Input", upvote=0,
+            ))
+        conn.commit()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def load(client, make_request, total, concurrency):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        method, url, kwargs = make_request(i)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / wall, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def jitter(rng, spread=0.05):
+    return CENTER[0] + rng.uniform(-spread, spread), CENTER[1] + rng.uniform(-spread, spread)
+
+
+def scenarios():
+    rng = random.Random(2)
+
+    def services(i):
+        lat, lng = jitter(rng)
+        return "GET", "/services", {"params": {"query": rng.choice(SERVICE_TYPES), "lat": lat, "lng": lng, "radius": 3}}
+
+    def locations(i):
+        lat, lng = jitter(rng)
+        return "GET", "/locations/", {"params": {"lat": lat, "lng": lng, "radius": 3}}
+
+    def reviews(i):
+        review_id = f"bench-{rng.randrange(200)}"
+        if i % 2:
+            return "GET", f"/reviews/{review_id}", {}
+        return "POST", "/reviews/", {"json": {"ID": review_id, "upvote": 0}}
+
+    return {"/services": services, "/locations/": locations, "/reviews/": reviews}
+
+
+async def run_load(base_url, args, google):
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        for name, make_request in scenarios().items():
+            # warm caches and connections before measuring
+            await load(client, make_request, min(args.concurrency, args.requests), args.concurrency)
+            results[name] = await load(client, make_request, args.requests, args.concurrency)
+            print(f"{name:<12} {results[name]}")
+
+    # /reviews/ latency while a wave of uncached /services requests is waiting on upstream
+    rng = random.Random(3)
+
+    def slow_services(i):
+        lat, lng = jitter(rng, spread=2.0)  # spread far enough that searches miss the cache
+        return "GET", "/services", {"params": {"query": rng.choice(SERVICE_TYPES), "lat": lat, "lng": lng, "radius": 3}}
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as services_client, \
+            httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as reviews_client:
+        background = asyncio.ensure_future(load(services_client, slow_services, args.concurrency, args.concurrency))
+        await asyncio.sleep(0.1)
+        name = "/reviews/ during /services"
+        results[name] = await load(reviews_client, scenarios()["/reviews/"], args.requests, args.concurrency)
+        print(f"{name:<12} {results[name]}")
+        await background
+
+    # a spike of users opening the map at the same new spot: everyone misses the cache at once,
+    # so upstream calls for the burst should stay close to those of a single search
+    rng = random.Random(4)
+    spike_center = (CENTER[0] + 1.0, CENTER[1] + 1.0)
+
+    def spike(i):
+        lat, lng = spike_center[0] + rng.uniform(-0.0001, 0.0001), spike_center[1] + rng.uniform(-0.0001, 0.0001)
+        return "GET", "/services", {"params": {"query": "Legal", "lat": lat, "lng": lng, "radius": 3}}
+
+    before = sum(google.config.calls.values())
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        name = "/services spike"
+        results[name] = await load(client, spike, args.concurrency, args.concurrency)
+    results[name]["upstream_calls"] = sum(google.config.calls.values()) - before
+    print(f"{name:<12} {results[name]}")
+    return results
+
+
+def compare(current, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+    print(f"\ncompared with {previous['commit']}:")
+    for name, stats in current["endpoints"].items():
+        old = previous["endpoints"].get(name)
+        if not old:
+            continue
+        deltas = "  ".join(
+            f"{key} {old[key]} -> {stats[key]} ({(stats[key] - old[key]) / old[key] * 100:+.0f}%)"
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps") if old[key]
+        )
+        print(f"{name:<12} {deltas}")
+
+
+def main():
+    args = parse_args()
+    google = FakeGoogleServer(FakeGoogleConfig(args.latency, args.results, error_rate=args.error_rate)).start()
+    gspread_client = FakeGspreadClient(args.sheet_rows, args.sheet_latency, args.error_rate)
+
+    # the app reads secrets.json and services.db from its working directory
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    with open("secrets.json", "w") as secrets_file:
+        json.dump({"GOOGLE_API_KEY": "fake"}, secrets_file)
+    os.environ["GOOGLE_MAPS_BASE_URL"] = google.base_url
+
+    import database
+    import clients
+    import server
+    clients.use(sheets=gspread_client)
+    database.create_table()
+    seed_locations(args.locations)
+
+    port = free_port()
+    app_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=app_server.run, daemon=True)
+    thread.start()
+    while not app_server.started:
+        time.sleep(0.05)
+
+    try:
+        endpoints = asyncio.run(run_load(f"http://127.0.0.1:{port}", args, google))
+    finally:
+        app_server.should_exit = True
+        thread.join()
+        google.stop()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "endpoints": endpoints,
+        "upstream_calls": dict(google.config.calls, sheet=gspread_client.spreadsheet.sheet1.calls),
+    }
+    output = args.output or os.path.join(BENCH_DIR, "results", f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("upstream calls:", results["upstream_calls"])
+    print("results written to", output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
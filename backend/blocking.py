@@ -0,0 +1,18 @@
+# Bounded thread pool for blocking work (SQLite, gspread) called from async request handlers
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads available for blocking calls; extra calls queue instead of starving the event loop
+BLOCKING_WORKERS = int(os.environ.get("BLOCKING_WORKERS", 16))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on the blocking pool and waits for it without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,145 @@
+# Parsing, validation and geocoding for bulk location imports (POST /locations/bulk)
+import csv
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import ValidationError
+from models import ServiceInput
+import map
+
+log = logging.getLogger(__name__)
+
+# Largest number of rows accepted in one import
+MAX_IMPORT_ROWS = int(os.environ.get("MAX_IMPORT_ROWS", 5000))
+# Addresses geocoded at the same time during an import
+IMPORT_GEOCODE_CONCURRENCY = int(os.environ.get("IMPORT_GEOCODE_CONCURRENCY", 8))
+
+# CSV cells holding several values separate them with semicolons
+CSV_LIST_COLUMNS = ("languages", "services")
+
+
+def parse_rows(body: bytes, content_type: str) -> list:
+    """
+    Parses an import body into one dict per row: a JSON array of ServiceInput objects, or CSV
+    with a header row of ServiceInput field names (plus optional lat and lng columns).
+
+    Raises:
+        ValueError: If the body cannot be parsed.
+    """
+    if "csv" in content_type:
+        return parse_csv_rows(body)
+    return parse_json_rows(body)
+
+
+def parse_json_rows(body: bytes) -> list:
+    try:
+        rows = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of locations")
+    return rows
+
+
+def parse_csv_rows(body: bytes) -> list:
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"CSV must be UTF-8: {e}")
+    rows = []
+    for record in csv.DictReader(io.StringIO(text)):
+        row = {key.strip(): value.strip() for key, value in record.items() if key and value and value.strip()}
+        for column in CSV_LIST_COLUMNS:
+            if column in row:
+                row[column] = [value.strip() for value in row[column].split(";") if value.strip()]
+        if "lat" in row or "lng" in row:
+            row["coordinates"] = [row.pop("lat", ""), row.pop("lng", "")]
+        rows.append(row)
+    return rows
+
+
+def _error_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors())
+
+
+def parse_coordinates(coordinates):
+    """
+    Returns (lat, lng) as floats, or None if no coordinates were given.
+
+    Raises:
+        ValueError: If the coordinates are not two numbers in range.
+    """
+    if not coordinates:
+        return None
+    if len(coordinates) != 2:
+        raise ValueError("coordinates must be [lat, lng]")
+    try:
+        lat, lng = float(coordinates[0]), float(coordinates[1])
+    except ValueError:
+        raise ValueError("coordinates must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("coordinates out of range")
+    return lat, lng
+
+
+def validate_rows(rows):
+    """
+    Validates every row in one pass.
+
+    Returns:
+        tuple: ([(row index, ServiceInput, (lat, lng) or None)], [{"row": index, "error": message}])
+    """
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            service_input = ServiceInput.parse_obj(row)
+            coordinates = parse_coordinates(service_input.coordinates)
+        except ValidationError as e:
+            errors.append({"row": index, "error": _error_message(e)})
+            continue
+        except ValueError as e:
+            errors.append({"row": index, "error": str(e)})
+            continue
+        valid.append((index, service_input, coordinates))
+    return valid, errors
+
+
+def _geocode(address):
+    # (coordinates or None, exception or None): one failing lookup (e.g. no API key, or the
+    # geocode cache unavailable) is reported for its rows instead of failing the whole import
+    try:
+        return map.get_coordinates(address), None
+    except Exception as e:
+        log.warning("Geocoding %r failed: %s", address, e)
+        return None, e
+
+
+def geocode_missing(valid):
+    """
+    Fills in coordinates for rows that have none by geocoding their addresses, each distinct
+    address once and several at a time, through the geocode cache.
+
+    Returns:
+        tuple: (rows with coordinates, [{"row": index, "error": message}] for addresses that could not be geocoded)
+    """
+    addresses = list({service_input.addr for _, service_input, coordinates in valid if coordinates is None})
+    if addresses:
+        with ThreadPoolExecutor(max_workers=IMPORT_GEOCODE_CONCURRENCY) as executor:
+            geocoded = dict(zip(addresses, executor.map(_geocode, addresses)))
+    else:
+        geocoded = {}
+
+    located, errors = [], []
+    for index, service_input, coordinates in valid:
+        if coordinates is None:
+            coordinates, error = geocoded[service_input.addr]
+            if error is not None:
+                errors.append({"row": index, "error": f"Geocoding failed for address: {service_input.addr}"})
+                continue
+            if coordinates is None:
+                errors.append({"row": index, "error": f"Could not geocode address: {service_input.addr}"})
+                continue
+        located.append((index, service_input, coordinates))
+    return located, errors
@@ -0,0 +1,184 @@
+# Process-wide upstream clients, created once and shared by every module: the parsed secrets,
+# pooled keep-alive HTTP clients for Google Maps, and the authorized Google Sheets client
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import gspread
+import httpx
+from google.oauth2.service_account import Credentials
+
+log = logging.getLogger(__name__)
+
+# Where the Google API key is read from
+SECRETS_PATH = os.environ.get("SECRETS_PATH", "secrets.json")
+# Connections kept to Google Maps, shared by all requests
+HTTP_MAX_CONNECTIONS = int(os.environ.get("PLACES_MAX_CONNECTIONS", 64))
+# Per-request timeout for Google Maps calls (seconds)
+HTTP_TIMEOUT = float(os.environ.get("PLACES_TIMEOUT", 5))
+# Extra attempts for a call that failed to connect, timed out or got a 429/5xx, and the first backoff (seconds)
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", 0.2))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+SHEETS_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+_limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+# Waiting for a free connection is bounded by the caller's overall deadline, not the per-call timeout
+_timeout = httpx.Timeout(HTTP_TIMEOUT, pool=None)
+
+_lock = threading.Lock()
+_secrets = None
+_transport = None  # httpx transport used instead of the network (e.g. httpx.MockTransport)
+_http_client = None
+_async_http_client = None
+_sheets_clients = {}  # key file path -> gspread client
+_sheets_override = None
+
+
+def get_secrets():
+    """
+    Returns the parsed secrets.json, reading it on first use only.
+    """
+    global _secrets
+    if _secrets is None:
+        with _lock:
+            if _secrets is None:
+                with open(SECRETS_PATH) as secrets_file:
+                    _secrets = json.load(secrets_file)
+    return _secrets
+
+
+def google_api_key():
+    return get_secrets()["GOOGLE_API_KEY"]
+
+
+def http_client():
+    """
+    Returns the shared blocking HTTP client (for background jobs such as geocoding).
+    """
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=_limits, timeout=_timeout, transport=_transport)
+    return _http_client
+
+
+def new_async_http_client():
+    """
+    Creates an async HTTP client with the shared settings, for code running its own event loop.
+    """
+    return httpx.AsyncClient(limits=_limits, timeout=_timeout, transport=_transport)
+
+
+def async_http_client():
+    """
+    Returns the shared async HTTP client used on the server's event loop.
+    """
+    global _async_http_client
+    if _async_http_client is None:
+        _async_http_client = new_async_http_client()
+    return _async_http_client
+
+
+def sheets_client(json_key_path):
+    """
+    Returns the Google Sheets client for a service account key file, authorized once.
+    The client refreshes its access token by itself when it expires.
+    """
+    if _sheets_override is not None:
+        return _sheets_override
+    with _lock:
+        client = _sheets_clients.get(json_key_path)
+        if client is None:
+            creds = Credentials.from_service_account_file(json_key_path, scopes=SHEETS_SCOPES)
+            client = _sheets_clients[json_key_path] = gspread.authorize(creds)
+        return client
+
+
+def _backoff(attempt):
+    return HTTP_RETRY_BACKOFF * (2 ** attempt)
+
+
+def get(url, **kwargs):
+    """
+    GETs a URL on the shared blocking client, retrying connection errors, timeouts and 429/5xx responses.
+
+    Raises:
+        httpx.HTTPError: If the last attempt failed to get a response.
+    """
+    for attempt in range(HTTP_RETRIES + 1):
+        last = attempt == HTTP_RETRIES
+        try:
+            response = http_client().get(url, **kwargs)
+        except httpx.TransportError:
+            if last:
+                raise
+        else:
+            if last or response.status_code not in RETRY_STATUS_CODES:
+                return response
+        time.sleep(_backoff(attempt))
+
+
+async def aget(client, url, **kwargs):
+    """
+    Async version of get, on the given async client.
+    """
+    for attempt in range(HTTP_RETRIES + 1):
+        last = attempt == HTTP_RETRIES
+        try:
+            response = await client.get(url, **kwargs)
+        except httpx.TransportError:
+            if last:
+                raise
+        else:
+            if last or response.status_code not in RETRY_STATUS_CODES:
+                return response
+        await asyncio.sleep(_backoff(attempt))
+
+
+def startup():
+    """
+    Loads the secrets and opens the shared async client; called once when the server starts.
+    """
+    try:
+        get_secrets()
+    except (OSError, ValueError) as e:
+        # /locations/ and /reviews/ still work; Google calls fail until the file is fixed
+        log.error("Could not load %s: %s", SECRETS_PATH, e)
+    async_http_client()
+
+
+async def shutdown():
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+
+
+def use(secrets=None, transport=None, sheets=None):
+    """
+    Swaps in local stand-ins for the real upstreams, e.g. in tests and benchmarks.
+
+    Args:
+        secrets (dict): Used instead of reading secrets.json.
+        transport (httpx transport): Used by the HTTP clients instead of the network
+            (e.g. httpx.MockTransport); the clients are recreated with it.
+        sheets: A gspread-compatible client returned by sheets_client for every key file.
+    """
+    global _secrets, _transport, _http_client, _async_http_client, _sheets_override
+    with _lock:
+        if secrets is not None:
+            _secrets = secrets
+        if transport is not None:
+            _transport = transport
+            _http_client = None
+            _async_http_client = None
+        if sheets is not None:
+            _sheets_override = sheets
@@ -0,0 +1,202 @@
+# Map clustering: services grouped into grid cells per zoom level of the standard web map
+# tile scheme (z/x/y, Web Mercator), kept up to date one point at a time
+import math
+import os
+import threading
+
+# Zoom levels with precomputed clusters; tiles above the last level list individual points
+CLUSTER_MAX_ZOOM = int(os.environ.get("CLUSTER_MAX_ZOOM", 16))
+# Each tile is split into this many cells per side, and a cell's services make one cluster
+# (on 256 px tiles, 8 cells are 32 px apart), so a clustered tile has at most 64 entries
+CLUSTER_CELLS_PER_TILE = 8
+
+# Web Mercator stops here; points further north or south are drawn at the edge
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def project(lat, lng):
+    """
+    Returns the Web Mercator position of a point as (x, y) in [0, 1], y growing southwards.
+    """
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def _cell(x, y, z):
+    cells = 2 ** z * CLUSTER_CELLS_PER_TILE
+    return min(int(x * cells), cells - 1), min(int(y * cells), cells - 1)
+
+
+class _Point:
+    __slots__ = ("handle", "group", "ID", "name", "lat", "lng", "x", "y", "categories", "source")
+
+    def __init__(self, handle, group, ID, name, lat, lng, categories, source):
+        self.handle = handle
+        self.group = group
+        self.ID = ID
+        self.name = name
+        self.lat = lat
+        self.lng = lng
+        self.x, self.y = project(lat, lng)
+        self.categories = categories
+        self.source = source
+
+    def key(self):
+        return self.name, self.lat, self.lng, self.categories, self.source
+
+    def record(self):
+        return {"ID": self.ID, "name": self.name, "coordinates": [self.lat, self.lng],
+                "servicetype": list(self.categories), "source": self.source}
+
+
+class ClusterIndex:
+    """
+    Services clustered per zoom level, for serving map tiles.
+
+    Every zoom level up to CLUSTER_MAX_ZOOM keeps a running total per grid cell, split by each
+    service's set of categories so a tile can be filtered by category: the count, the sums of
+    the latitudes and longitudes (for the cluster's center) and the XOR of the members' handles.
+    Adding, moving or removing a service only updates the one cell it is in on each level, and
+    when a cell is down to one service the XOR is that service's handle.
+
+    Services are kept in named groups (e.g. one per data source), so each group can be
+    re-synced with sync() without touching the others.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._points = {}  # ID -> _Point
+        self._by_handle = {}  # handle -> _Point
+        self._next_handle = 1
+        # per zoom level: cell -> {categories: [count, lat sum, lng sum, handle xor]}
+        self._levels = [{} for _ in range(CLUSTER_MAX_ZOOM + 1)]
+        # the handles in each cell of the last level, for listing points above CLUSTER_MAX_ZOOM
+        self._members = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, group, ID, name, lat, lng, categories, source):
+        """
+        Adds a service, or moves or updates it if its ID is already in the index.
+        """
+        with self._lock:
+            self._add(group, ID, name, lat, lng, tuple(categories), source)
+
+    def remove(self, ID):
+        with self._lock:
+            self._remove(ID)
+
+    def sync(self, group, points):
+        """
+        Makes a group hold exactly the given services, updating only those that were added,
+        changed or removed since the last sync.
+
+        Args:
+            group (str): The group to sync.
+            points (dict): ID -> (name, lat, lng, categories, source).
+
+        Returns:
+            int: The number of services added, changed or removed.
+        """
+        with self._lock:
+            changed = 0
+            for ID in [ID for ID, point in self._points.items() if point.group == group and ID not in points]:
+                self._remove(ID)
+                changed += 1
+            for ID, (name, lat, lng, categories, source) in points.items():
+                categories = tuple(categories)
+                point = self._points.get(ID)
+                if point is None or point.group != group or point.key() != (name, lat, lng, categories, source):
+                    self._add(group, ID, name, lat, lng, categories, source)
+                    changed += 1
+            return changed
+
+    def _add(self, group, ID, name, lat, lng, categories, source):
+        self._remove(ID)
+        point = _Point(self._next_handle, group, ID, name, lat, lng, categories, source)
+        self._next_handle += 1
+        self._points[ID] = point
+        self._by_handle[point.handle] = point
+        self._update(point, 1)
+        self._members.setdefault(_cell(point.x, point.y, CLUSTER_MAX_ZOOM), set()).add(point.handle)
+
+    def _remove(self, ID):
+        point = self._points.pop(ID, None)
+        if point is None:
+            return
+        del self._by_handle[point.handle]
+        self._update(point, -1)
+        cell = _cell(point.x, point.y, CLUSTER_MAX_ZOOM)
+        members = self._members[cell]
+        members.discard(point.handle)
+        if not members:
+            del self._members[cell]
+
+    def _update(self, point, sign):
+        for z, cells in enumerate(self._levels):
+            cell = _cell(point.x, point.y, z)
+            by_categories = cells.setdefault(cell, {})
+            totals = by_categories.setdefault(point.categories, [0, 0.0, 0.0, 0])
+            totals[0] += sign
+            totals[1] += sign * point.lat
+            totals[2] += sign * point.lng
+            totals[3] ^= point.handle
+            if not totals[0]:
+                del by_categories[point.categories]
+                if not by_categories:
+                    del cells[cell]
+
+    def tile(self, z, x, y, categories=None):
+        """
+        Returns the clusters and points in a tile. Up to CLUSTER_MAX_ZOOM, every non-empty cell
+        of the tile is one cluster, or one point if it holds a single service; above it, every
+        service in the tile is a point.
+
+        Args:
+            categories (list): Only count services of any of these categories, if given.
+
+        Returns:
+            dict: {"clusters": [{"count", "coordinates"}], "points": [{"ID", "name", "coordinates", "servicetype", "source"}]}
+        """
+        wanted = set(categories) if categories else None
+        clusters, points = [], []
+        with self._lock:
+            if z > CLUSTER_MAX_ZOOM:
+                for point in self._points_in_tile(z, x, y):
+                    if wanted is None or wanted.intersection(point.categories):
+                        points.append(point.record())
+                return {"clusters": clusters, "points": points}
+
+            cells = self._levels[z]
+            first_x, first_y = x * CLUSTER_CELLS_PER_TILE, y * CLUSTER_CELLS_PER_TILE
+            for cell_x in range(first_x, first_x + CLUSTER_CELLS_PER_TILE):
+                for cell_y in range(first_y, first_y + CLUSTER_CELLS_PER_TILE):
+                    by_categories = cells.get((cell_x, cell_y))
+                    if by_categories is None:
+                        continue
+                    count, lat_sum, lng_sum, handles = 0, 0.0, 0.0, 0
+                    for cell_categories, totals in by_categories.items():
+                        if wanted is None or wanted.intersection(cell_categories):
+                            count += totals[0]
+                            lat_sum += totals[1]
+                            lng_sum += totals[2]
+                            handles ^= totals[3]
+                    if count == 1:
+                        points.append(self._by_handle[handles].record())
+                    elif count:
+                        clusters.append({"count": count, "coordinates": [lat_sum / count, lng_sum / count]})
+        return {"clusters": clusters, "points": points}
+
+    def _points_in_tile(self, z, x, y):
+        # the last level's cells overlapping the tile, then an exact check per point
+        scale = 2 ** CLUSTER_MAX_ZOOM * CLUSTER_CELLS_PER_TILE / 2 ** z
+        for cell_x in range(int(x * scale), int((x + 1) * scale) + 1):
+            for cell_y in range(int(y * scale), int((y + 1) * scale) + 1):
+                for handle in self._members.get((cell_x, cell_y), ()):
+                    point = self._by_handle[handle]
+                    if x <= point.x * 2 ** z < x + 1 and y <= point.y * 2 ** z < y + 1:
+                        yield point
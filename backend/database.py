@@ -1,9 +1,49 @@
 import sqlite3
+import json
+import os
+import queue
+from contextlib import contextmanager
+from geo import bounding_box
+from fulltext import FTS_COLUMNS, create_fts_table, service_text
 
-def create_connection():
-    conn = sqlite3.connect('services.db')  # Database file
+# Number of idle connections kept open for reuse
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+# SQLite limits the number of ? parameters in one statement; batch lookups are chunked below it
+MAX_QUERY_PARAMS = 500
+
+# Main database file
+DB_PATH = 'services.db'
+
+_pools = {}  # database file -> idle connections
+
+def create_connection(path=DB_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False)  # Database file
+    conn.execute("PRAGMA busy_timeout=5000")  # first, so switching to WAL waits for other processes too
+    conn.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, far fewer fsyncs
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
+@contextmanager
+def pooled_connection(path=DB_PATH):
+    """Borrow a connection from the pool, returning it (or closing it if the pool is full) afterwards."""
+    pool = _pools.get(path)
+    if pool is None:
+        pool = _pools.setdefault(path, queue.LifoQueue(maxsize=POOL_SIZE))
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = create_connection(path)
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    try:
+        pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def create_table():
     conn = create_connection()
     cursor = conn.cursor()
@@ -38,19 +78,368 @@ def create_table():
     )
     ''')
 
+    # Geocoding cache, keyed by normalized address (lat/lng are NULL for addresses with no results)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS geocodes (
+        address TEXT PRIMARY KEY,
+        lat REAL,
+        lng REAL,
+        fetched_at REAL NOT NULL
+    )
+    ''')
+
     conn.commit()
+    migrate(conn)
     conn.close()
 
 
+def _migration_1(cursor):
+    """Typed lat/lng columns, a service type join table and the spatial index."""
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(services)")}
+    if "lat" not in columns:
+        cursor.execute("ALTER TABLE services ADD COLUMN lat REAL")
+    if "lng" not in columns:
+        cursor.execute("ALTER TABLE services ADD COLUMN lng REAL")
+    cursor.execute('''
+    UPDATE services
+    SET lat = CAST(json_extract(coordinates, '$[0]') AS REAL),
+        lng = CAST(json_extract(coordinates, '$[1]') AS REAL)
+    WHERE json_valid(coordinates) AND json_array_length(coordinates) = 2
+    ''')
+
+    # One row per (service, type) so category filters can use an index
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS service_types (
+        servicetype TEXT NOT NULL,
+        service_id TEXT NOT NULL REFERENCES services(ID) ON DELETE CASCADE,
+        PRIMARY KEY (servicetype, service_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS service_types_service_id ON service_types (service_id)")
+    cursor.execute('''
+    INSERT OR IGNORE INTO service_types (servicetype, service_id)
+    SELECT json_each.value, services.ID
+    FROM services, json_each(services.servicetype)
+    WHERE json_valid(services.servicetype)
+    ''')
+
+    # Spatial index over user-submitted services, keyed by services.rowid
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS services_rtree USING rtree (
+        id,
+        min_lat, max_lat,
+        min_lng, max_lng
+    )
+    ''')
+    cursor.execute('''
+    INSERT OR REPLACE INTO services_rtree (id, min_lat, max_lat, min_lng, max_lng)
+    SELECT rowid, lat, lat, lng, lng FROM services WHERE lat IS NOT NULL AND lng IS NOT NULL
+    ''')
+
+
+def _migration_2(cursor):
+    """Freshness metadata for services synced from Google Sheets and Places."""
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(services)")}
+    if "fetched_at" not in columns:
+        cursor.execute("ALTER TABLE services ADD COLUMN fetched_at REAL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS services_source_fetched_at ON services (source, fetched_at)")
+
+
+def _migration_3(cursor):
+    """Full-text index over the services' name, types, languages, demographic and summary, keyed by services.rowid."""
+    create_fts_table(cursor, "services_fts")
+    cursor.execute(f'''
+    INSERT INTO services_fts (rowid, {", ".join(FTS_COLUMNS)})
+    SELECT rowid, name, coalesce(servicetype, ''), coalesce(languages, ''), coalesce(demographic, ''), coalesce(summary, '')
+    FROM services
+    ''')
+
+
+# Columns whose changes are reported to clients; fetched_at is sync bookkeeping
+_SERVICE_CHANGE_COLUMNS = ("name", "servicetype", "extrafilters", "demographic", "website", "summary", "address",
+                           "coordinates", "neighborhoods", "hours", "phone", "languages", "googlelink", "source",
+                           "upvote", "lat", "lng")
+
+
+def _record_change_sql(kind, item_id, deleted):
+    # statements for a trigger body: take the next version and stamp the item with it, keeping
+    # the version the item was created at unless it is being re-created after a delete
+    return f'''
+        UPDATE change_version SET version = version + 1;
+        INSERT INTO changes (kind, item_id, version, created_version, deleted)
+        VALUES ('{kind}', {item_id}, (SELECT version FROM change_version), (SELECT version FROM change_version), {deleted})
+        ON CONFLICT (kind, item_id) DO UPDATE SET
+            version = excluded.version,
+            created_version = CASE WHEN changes.deleted THEN excluded.version ELSE changes.created_version END,
+            deleted = excluded.deleted;
+    '''
+
+
+def _migration_4(cursor):
+    """Change versions for stored services and upvotes, for delta sync (/changes) and ETags.
+
+    Every item has one row holding the version of its latest change; deleted items stay as
+    tombstones. Triggers record the changes, so every writer (any process) is covered.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS changes (
+        kind TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        created_version INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        digest TEXT,
+        PRIMARY KEY (kind, item_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS changes_version ON changes (version)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS change_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+
+    # what is already stored counts as created, one version per item
+    cursor.execute('''
+    INSERT INTO changes (kind, item_id, version, created_version)
+    SELECT kind, item_id, row_number() OVER (), row_number() OVER ()
+    FROM (SELECT 'service' AS kind, ID AS item_id FROM services UNION ALL SELECT 'upvote', ID FROM reviews)
+    ''')
+    cursor.execute("INSERT INTO change_version (id, version) SELECT 0, count(*) FROM changes")
+
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in _SERVICE_CHANGE_COLUMNS)
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS services_changes_insert AFTER INSERT ON services BEGIN {_record_change_sql('service', 'NEW.ID', 0)} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS services_changes_update AFTER UPDATE ON services WHEN {changed} BEGIN {_record_change_sql('service', 'NEW.ID', 0)} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS services_changes_delete AFTER DELETE ON services BEGIN {_record_change_sql('service', 'OLD.ID', 1)} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS reviews_changes_insert AFTER INSERT ON reviews BEGIN {_record_change_sql('upvote', 'NEW.ID', 0)} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS reviews_changes_update AFTER UPDATE OF upvote ON reviews WHEN OLD.upvote IS NOT NEW.upvote BEGIN {_record_change_sql('upvote', 'NEW.ID', 0)} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS reviews_changes_delete AFTER DELETE ON reviews BEGIN {_record_change_sql('upvote', 'OLD.ID', 1)} END")
+
+
+def _migration_5(cursor):
+    """Look up stored services by source and name, e.g. to skip imported locations that already exist."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS services_source_name ON services (source, name)")
+
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+]
+
+
+def migrate(conn):
+    """Bring the database schema up to date, one transaction per migration.
+
+    Safe when several worker processes start at once: each migration runs under the write
+    lock and re-reads the version first, so one that another process applied is skipped.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+    while True:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                cursor.execute("COMMIT")
+                return
+            MIGRATIONS[version](cursor)
+            cursor.execute(f"PRAGMA user_version = {version + 1}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+
+def index_service_location(cursor, rowid, lat, lng):
+    """Add (or move) a stored service in the spatial index."""
+    cursor.execute(
+        "INSERT OR REPLACE INTO services_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+        (rowid, lat, lat, lng, lng)
+    )
+
+
+def index_service_text(cursor, rowid, service):
+    """Add (or replace) a stored service in the full-text index."""
+    cursor.execute("DELETE FROM services_fts WHERE rowid = ?", (rowid,))
+    placeholders = ", ".join("?" * (len(FTS_COLUMNS) + 1))
+    cursor.execute(
+        f"INSERT INTO services_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES ({placeholders})",
+        (rowid,) + service_text(service)
+    )
+
+
+# Inserts one services row, with the values from _service_row
+_INSERT_SERVICE_SQL = '''
+INSERT INTO services (ID, name, servicetype, extrafilters, demographic, website,
+                      summary, address, coordinates, neighborhoods, hours, phone,
+                      languages, googlelink, source, upvote, lat, lng)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _service_row(service):
+    """The services table values for a service, in _INSERT_SERVICE_SQL's column order."""
+    lat, lng = (float(service.coordinates[0]), float(service.coordinates[1])) \
+        if service.coordinates and len(service.coordinates) == 2 else (None, None)
+    return (
+        service.ID,
+        service.name,
+        json.dumps(service.servicetype),
+        json.dumps(service.extrafilters) if service.extrafilters is not None else None,
+        service.demographic,
+        service.website,
+        service.summary,
+        json.dumps(service.address),
+        json.dumps(service.coordinates) if service.coordinates else None,
+        service.neighborhoods,
+        service.hours,
+        service.phone,
+        json.dumps(service.languages),
+        service.googlelink,
+        service.source,
+        service.upvote,
+        lat,
+        lng
+    )
+
+
+def insert_service(cursor, service):
+    """Store a new service along with its typed location, service types, spatial and full-text index entries."""
+    row = _service_row(service)
+    cursor.execute(_INSERT_SERVICE_SQL, row)
+    rowid = cursor.lastrowid
+    lat, lng = row[-2:]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO service_types (servicetype, service_id) VALUES (?, ?)",
+        [(servicetype, service.ID) for servicetype in service.servicetype or []]
+    )
+    if lat is not None:
+        index_service_location(cursor, rowid, lat, lng)
+    index_service_text(cursor, rowid, service)
+
+
+def insert_services(cursor, services):
+    """Store many new services with executemany, then index the whole batch in one statement per index.
+
+    Runs inside the caller's transaction; the caller commits.
+    """
+    cursor.executemany(_INSERT_SERVICE_SQL, [_service_row(service) for service in services])
+    cursor.executemany(
+        "INSERT OR IGNORE INTO service_types (servicetype, service_id) VALUES (?, ?)",
+        [(servicetype, service.ID) for service in services for servicetype in service.servicetype or []]
+    )
+
+    # the batch's rowids are only known to SQLite, so both indexes are filled from the rows just written
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS batch_ids (ID TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM batch_ids")
+    cursor.executemany("INSERT INTO batch_ids (ID) VALUES (?)", [(service.ID,) for service in services])
+    cursor.execute('''
+    INSERT INTO services_rtree (id, min_lat, max_lat, min_lng, max_lng)
+    SELECT services.rowid, lat, lat, lng, lng FROM services JOIN batch_ids USING (ID)
+    WHERE lat IS NOT NULL AND lng IS NOT NULL
+    ''')
+    cursor.execute(f'''
+    INSERT INTO services_fts (rowid, {", ".join(FTS_COLUMNS)})
+    SELECT services.rowid, name, coalesce(servicetype, ''), coalesce(languages, ''), coalesce(demographic, ''), coalesce(summary, '')
+    FROM services JOIN batch_ids USING (ID)
+    ''')
+    cursor.execute("DELETE FROM batch_ids")
+
+
+def insert_new_services(services) -> set:
+    """Store a batch of services in one transaction, skipping any whose ID is already stored or
+    whose name is already stored for the same source.
+
+    Returns the IDs that were skipped.
+    """
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        # take the write lock up front so no other writer can add one of these services in between
+        cursor.execute("BEGIN IMMEDIATE")
+        stored_ids, stored_names = set(), set()
+        ids = [service.ID for service in services]
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            stored_ids.update(row[0] for row in cursor.execute(f"SELECT ID FROM services WHERE ID IN ({placeholders})", chunk))
+        names_by_source = {}
+        for service in services:
+            names_by_source.setdefault(service.source, []).append(service.name)
+        for source, names in names_by_source.items():
+            for start in range(0, len(names), MAX_QUERY_PARAMS - 1):
+                chunk = names[start:start + MAX_QUERY_PARAMS - 1]
+                placeholders = ", ".join("?" * len(chunk))
+                stored_names.update(cursor.execute(
+                    f"SELECT source, name FROM services WHERE source IS ? AND name IN ({placeholders})", [source] + chunk
+                ).fetchall())
+        existing = {service.ID for service in services
+                    if service.ID in stored_ids or (service.source, service.name) in stored_names}
+        insert_services(cursor, [service for service in services if service.ID not in existing])
+        conn.commit()
+    return existing
+
+
+def get_services_in_box(lat: float, lng: float, radius: float, category=None, sources=None, search=None) -> list:
+    """Fetch the stored services inside the bounding box of a radius query.
+
+    category may be one service type or a list of them (a service matching any is returned);
+    sources restricts the result to services from those sources. search is an FTS5 query (see
+    fulltext.fts_query); only matching services are returned, best match first.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius)
+    query = '''
+        SELECT services.* FROM services
+        JOIN services_rtree ON services.rowid = services_rtree.id
+    '''
+    if search is not None:
+        query += " JOIN services_fts ON services.rowid = services_fts.rowid"
+    query += '''
+        WHERE services_rtree.max_lat >= ? AND services_rtree.min_lat <= ?
+          AND services_rtree.max_lng >= ? AND services_rtree.min_lng <= ?
+    '''
+    params = [min_lat, max_lat, min_lng, max_lng]
+    if search is not None:
+        query += " AND services_fts MATCH ?"
+        params.append(search)
+    if category is not None:
+        categories = [category] if isinstance(category, str) else list(category)
+        placeholders = ", ".join("?" * len(categories))
+        query += f" AND services.ID IN (SELECT service_id FROM service_types WHERE servicetype IN ({placeholders}))"
+        params.extend(categories)
+    if sources is not None:
+        placeholders = ", ".join("?" * len(sources))
+        query += f" AND services.source IN ({placeholders})"
+        params.extend(sources)
+    if search is not None:
+        query += " ORDER BY services_fts.rank"
+    with pooled_connection() as conn:
+        cursor = conn.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return rows
+
+
+def get_service_points(sources=None) -> list:
+    """Fetch the ID, name, service types, source and location of every stored service that has a location.
+
+    sources restricts the result to services from those sources.
+    """
+    query = "SELECT ID, name, servicetype, source, lat, lng FROM services WHERE lat IS NOT NULL AND lng IS NOT NULL"
+    params = []
+    if sources is not None:
+        placeholders = ", ".join("?" * len(sources))
+        query += f" AND source IN ({placeholders})"
+        params.extend(sources)
+    with pooled_connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
 def get_upvote_by_id(review_id: str) -> int:
     """Fetch the upvote count for a given review ID."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Query to select upvote by ID
-    cursor.execute("SELECT upvote FROM reviews WHERE ID = ?", (review_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with pooled_connection() as conn:
+        # Query to select upvote by ID
+        row = conn.execute("SELECT upvote FROM reviews WHERE ID = ?", (review_id,)).fetchone()
 
     if row is None:
         return 0; # Raise an exception if no review is found
@@ -59,3 +448,99 @@ def get_upvote_by_id(review_id: str) -> int:
     return row[0]
 
 
+def get_upvotes(review_ids) -> dict:
+    """Fetch the upvote counts for many review IDs at once; IDs without reviews map to 0."""
+    upvotes = dict.fromkeys(review_ids, 0)
+    ids = list(upvotes)
+    with pooled_connection() as conn:
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor = conn.execute(f"SELECT ID, upvote FROM reviews WHERE ID IN ({placeholders})", chunk)
+            upvotes.update(cursor.fetchall())
+    return upvotes
+
+
+def increment_upvotes(counts: dict):
+    """Atomically add to the upvote counts of many review IDs in one transaction."""
+    with pooled_connection() as conn:
+        # a single UPSERT per ID, so concurrent increments are never lost
+        conn.executemany(
+            '''
+            INSERT INTO reviews (ID, upvote) VALUES (?, ?)
+            ON CONFLICT(ID) DO UPDATE SET upvote = upvote + excluded.upvote
+            ''',
+            counts.items()
+        )
+        conn.commit()
+
+
+def get_change_version() -> int:
+    """Fetch the latest change version of the stored services and upvotes."""
+    with pooled_connection() as conn:
+        return conn.execute("SELECT version FROM change_version").fetchone()[0]
+
+
+def get_changes(since: int, kinds, limit: int) -> list:
+    """Fetch the latest change of every item of the given kinds changed after version since, oldest first.
+
+    Returns (version, kind, item_id, created_version, deleted, digest) rows, at most limit of them.
+    """
+    placeholders = ", ".join("?" * len(kinds))
+    with pooled_connection() as conn:
+        return conn.execute(
+            f"""
+            SELECT version, kind, item_id, created_version, deleted, digest FROM changes
+            WHERE version > ? AND kind IN ({placeholders})
+            ORDER BY version LIMIT ?
+            """,
+            (since, *kinds, limit)
+        ).fetchall()
+
+
+def record_changes(kind: str, digests: dict) -> int:
+    """Record the changes that turn the stored set of items of a kind into the given one, for items
+    kept outside the services table (such as the sheet snapshot). An item whose digest is unchanged
+    keeps its version.
+
+    digests maps item IDs to a digest of their content. Returns the number of changes recorded.
+    """
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        stored = {
+            item_id: (digest, deleted) for item_id, digest, deleted in
+            cursor.execute("SELECT item_id, digest, deleted FROM changes WHERE kind = ?", (kind,))
+        }
+        changes = [(item_id, digest, 0) for item_id, digest in digests.items() if stored.get(item_id) != (digest, 0)]
+        changes += [(item_id, digest, 1) for item_id, (digest, deleted) in stored.items() if not deleted and item_id not in digests]
+        for item_id, digest, deleted in changes:
+            cursor.execute("UPDATE change_version SET version = version + 1")
+            cursor.execute(
+                '''
+                INSERT INTO changes (kind, item_id, version, created_version, deleted, digest)
+                VALUES (?, ?, (SELECT version FROM change_version), (SELECT version FROM change_version), ?, ?)
+                ON CONFLICT (kind, item_id) DO UPDATE SET
+                    version = excluded.version,
+                    created_version = CASE WHEN changes.deleted THEN excluded.version ELSE changes.created_version END,
+                    deleted = excluded.deleted,
+                    digest = excluded.digest
+                ''',
+                (kind, item_id, deleted, digest)
+            )
+        conn.commit()
+    return len(changes)
+
+
+def get_services_by_id(service_ids) -> list:
+    """Fetch the stored services with the given IDs, as dicts keyed by column name."""
+    ids = list(service_ids)
+    rows = []
+    with pooled_connection() as conn:
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor = conn.execute(f"SELECT * FROM services WHERE ID IN ({placeholders})", chunk)
+            columns = [column[0] for column in cursor.description]
+            rows.extend(dict(zip(columns, row)) for row in cursor.fetchall())
+    return rows
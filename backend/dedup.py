@@ -0,0 +1,85 @@
+# Linear-time deduplication of services by ID, normalized name and nearby coordinates
+import math
+import re
+from geo import METERS_PER_DEGREE, haversine
+
+# Two services closer than this are treated as the same place (meters)
+DEDUP_TOLERANCE_METERS = 25.0
+
+_CELL_DEGREES = DEDUP_TOLERANCE_METERS / METERS_PER_DEGREE
+
+
+def _col_degrees(row):
+    # a degree of longitude shrinks with cos(lat); size the row's cells for the poleward edge of
+    # the row and its neighbours, so every cell in a 3x3 block is at least the tolerance wide
+    edge = min(max(abs(row - 1), abs(row + 2)) * _CELL_DEGREES, 90.0)
+    return _CELL_DEGREES / max(math.cos(math.radians(edge)), 0.01)
+
+
+def normalize_name(name):
+    """
+    Lowercases a name and drops punctuation and extra whitespace, so "St. Mary's  Center"
+    and "st marys center" compare equal.
+    """
+    name = re.sub(r"[^\w\s]", "", str(name).lower())
+    return " ".join(name.split())
+
+
+class ServiceDeduper:
+    """
+    Remembers the services seen so far and tells whether a new one duplicates any of them.
+
+    A service is a duplicate if it has the same ID, the same normalized name, or a location
+    within DEDUP_TOLERANCE_METERS of a service already seen. Locations are bucketed into
+    grid cells about the size of the tolerance (wider in degrees of longitude away from the
+    equator, one width per row of cells), so each check only looks at the 3x3 block
+    of cells around the point instead of every service.
+    """
+
+    def __init__(self):
+        self._ids = set()
+        self._names = set()
+        self._cells = {}  # (row, col) -> list of (lat, lng)
+
+    def _cell(self, lat, lng):
+        row = int(lat // _CELL_DEGREES)
+        return row, int(lng // _col_degrees(row))
+
+    def _near(self, lat, lng):
+        row = int(lat // _CELL_DEGREES)
+        for dr in (-1, 0, 1):
+            # rows have their own cell widths, so find the point's column in each row
+            col = int(lng // _col_degrees(row + dr))
+            for dc in (-1, 0, 1):
+                for other_lat, other_lng in self._cells.get((row + dr, col + dc), ()):
+                    if haversine(lat, lng, other_lat, other_lng) <= DEDUP_TOLERANCE_METERS:
+                        return True
+        return False
+
+    def is_duplicate(self, service):
+        if service.ID and str(service.ID) in self._ids:
+            return True
+        if service.name and normalize_name(service.name) in self._names:
+            return True
+        return any(self._near(float(lat), float(lng)) for lat, lng in service.coordinates or [])
+
+    def add(self, service):
+        """
+        Records a service without checking it.
+        """
+        if service.ID:
+            self._ids.add(str(service.ID))
+        if service.name:
+            self._names.add(normalize_name(service.name))
+        for lat, lng in service.coordinates or []:
+            lat, lng = float(lat), float(lng)
+            self._cells.setdefault(self._cell(lat, lng), []).append((lat, lng))
+
+    def add_if_new(self, service):
+        """
+        Records the service and returns True, or returns False if it duplicates one already seen.
+        """
+        if self.is_duplicate(service):
+            return False
+        self.add(service)
+        return True
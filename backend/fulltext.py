@@ -0,0 +1,117 @@
+# Keyword search over services with SQLite FTS5, for the services table and for in-memory services
+import re
+import sqlite3
+import threading
+
+# Indexed text columns and their bm25 weights; a hit in the name counts the most
+FTS_COLUMNS = ("name", "servicetype", "languages", "demographic", "summary")
+FTS_WEIGHTS = (10.0, 5.0, 3.0, 3.0, 1.0)
+# unicode61 folds case and diacritics; the prefix indexes keep short prefix queries ("asyl*") fast
+FTS_OPTIONS = "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'"
+# Words of a search beyond this are ignored
+MAX_SEARCH_TERMS = 16
+
+
+def fts_query(text):
+    """
+    Turns free text from a user into an FTS5 query that matches services containing every word
+    (each as a prefix). Operators and quotes in the text are treated as plain separators.
+
+    Returns:
+        str: The FTS5 query, or None if the text has no words.
+    """
+    terms = re.findall(r"\w+", text or "")[:MAX_SEARCH_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def create_fts_table(cursor, table):
+    """
+    Creates an FTS5 table with the service text columns, ranked by weighted bm25.
+    """
+    cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5 ({', '.join(FTS_COLUMNS)}, {FTS_OPTIONS})")
+    # the default ranking of `ORDER BY rank` is stored with the table
+    weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+    cursor.execute(f"INSERT INTO {table} ({table}, rank) VALUES ('rank', 'bm25({weights})')")
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(item) for item in value)
+    return str(value)
+
+
+def service_text(service):
+    """
+    Returns the indexed text of a Service (or ServiceModel), one value per FTS column.
+    """
+    return tuple(_text(getattr(service, column)) for column in FTS_COLUMNS)
+
+
+class TextIndex:
+    """
+    In-memory FTS5 index over Service objects that are not stored in services.db, such as the
+    sheet snapshot. Entries are added and removed one at a time under caller-chosen keys.
+    """
+
+    def __init__(self):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        self._rowids = {}  # key -> rowid
+        self._services = {}  # rowid -> Service
+        self._next_rowid = 1
+        create_fts_table(self._conn.cursor(), "services_fts")
+
+    def add(self, key, service):
+        with self._lock:
+            self._remove(key)
+            rowid = self._next_rowid
+            self._next_rowid += 1
+            placeholders = ", ".join("?" * (len(FTS_COLUMNS) + 1))
+            self._conn.execute(
+                f"INSERT INTO services_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES ({placeholders})",
+                (rowid,) + service_text(service)
+            )
+            self._rowids[key] = rowid
+            self._services[rowid] = service
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        rowid = self._rowids.pop(key, None)
+        if rowid is not None:
+            self._conn.execute("DELETE FROM services_fts WHERE rowid = ?", (rowid,))
+            del self._services[rowid]
+
+    def search(self, query):
+        """
+        Finds the indexed services matching an FTS5 query (as built by fts_query).
+
+        Returns:
+            dict: Service -> rank, lower is a better match.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT rowid, rank FROM services_fts WHERE services_fts MATCH ?", (query,)).fetchall()
+            return {self._services[rowid]: rank for rowid, rank in rows}
+
+    @classmethod
+    def match(cls, services, query):
+        """
+        Returns the services matching an FTS5 query, best match first, using a throwaway index.
+        """
+        index = cls()
+        for key, service in enumerate(services):
+            index.add(key, service)
+        return rank_matches(services, index.search(query))
+
+
+def rank_matches(services, ranks):
+    """
+    Keeps the services that have a rank, best match first (ties keep their original order).
+    """
+    return sorted((service for service in services if service in ranks), key=ranks.__getitem__)
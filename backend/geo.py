@@ -0,0 +1,137 @@
+# Distance math shared by the spreadsheet and server code
+import math
+import numpy as np
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS_METERS = 6371000.0
+# Meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320.0
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Calculates the distance between two geographic points using the Haversine formula.
+
+    Returns:
+        float: Distance in meters.
+    """
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlng = math.radians(lng2) - math.radians(lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def haversine_many(lat, lng, lats, lngs):
+    """
+    Calculates the distance from one point to many points in a single vectorized pass.
+
+    Args:
+        lat (float): Latitude of the origin.
+        lng (float): Longitude of the origin.
+        lats (array-like): Latitudes of the points.
+        lngs (array-like): Longitudes of the points.
+
+    Returns:
+        numpy.ndarray: Distances in meters, one per point.
+    """
+    lats_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs_rad = np.radians(np.asarray(lngs, dtype=np.float64))
+    return _haversine_rad(math.radians(lat), math.radians(lng), lats_rad, lngs_rad, np.cos(lats_rad))
+
+
+def _haversine_rad(lat_rad, lng_rad, lats_rad, lngs_rad, cos_lats):
+    a = np.sin((lats_rad - lat_rad) / 2) ** 2 + math.cos(lat_rad) * cos_lats * np.sin((lngs_rad - lng_rad) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def bounding_box(lat, lng, radius):
+    """
+    Returns (min_lat, max_lat, min_lng, max_lng) enclosing a circle of radius meters.
+    """
+    dlat = radius / METERS_PER_DEGREE
+    # longitude degrees shrink towards the poles; clamp so the box stays finite
+    dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def snap_to_grid(lat, lng, radius, cell_degrees, radius_step):
+    """
+    Snaps a search to the center of its grid cell and rounds its radius up to a whole step,
+    so searches a few meters apart map to the same key.
+
+    Returns:
+        tuple: (lat, lng, radius)
+    """
+    cell_lat = round(round(lat / cell_degrees) * cell_degrees, 6)
+    cell_lng = round(round(lng / cell_degrees) * cell_degrees, 6)
+    cell_radius = max(1, math.ceil(radius / radius_step)) * radius_step
+    return cell_lat, cell_lng, cell_radius
+
+
+class PointSet:
+    """
+    A fixed set of coordinates kept in contiguous NumPy arrays for batch distance queries.
+
+    Each point belongs to an owner index (e.g. the position of a service in a list), so an
+    owner with several addresses can be matched by its nearest one.
+
+    Args:
+        points (list): (owner, lat, lng) tuples.
+    """
+
+    def __init__(self, points):
+        owners, lats, lngs = zip(*points) if points else ((), (), ())
+        self.owners = np.asarray(owners, dtype=np.int64)
+        self.lats_rad = np.radians(np.asarray(lats, dtype=np.float64))
+        self.lngs_rad = np.radians(np.asarray(lngs, dtype=np.float64))
+        # cos(lat) of every point never changes, so it is computed once here
+        self.cos_lats = np.cos(self.lats_rad)
+
+    @classmethod
+    def from_coordinates(cls, coordinate_lists):
+        """
+        Builds a PointSet from one list of (lat, lng) tuples per owner.
+        """
+        return cls([
+            (owner, float(lat), float(lng))
+            for owner, coordinates in enumerate(coordinate_lists)
+            for lat, lng in coordinates
+        ])
+
+    def __len__(self):
+        return len(self.owners)
+
+    def distances(self, lat, lng):
+        """
+        Returns the distance in meters from (lat, lng) to every point.
+        """
+        return _haversine_rad(math.radians(lat), math.radians(lng), self.lats_rad, self.lngs_rad, self.cos_lats)
+
+    def owner_distances(self, lat, lng, owner_count):
+        """
+        Returns each owner's distance in meters to its nearest point (inf for owners without points).
+        """
+        result = np.full(owner_count, np.inf)
+        if len(self):
+            np.minimum.at(result, self.owners, self.distances(lat, lng))
+        return result
+
+    def within(self, lat, lng, radius):
+        """
+        Finds the owners with a point within radius meters of (lat, lng).
+
+        Returns:
+            tuple: (owners, distances) ordered nearest first, each owner listed once at its nearest point.
+        """
+        if not len(self):
+            return [], []
+        distances = self.distances(lat, lng)
+        hits = np.flatnonzero(distances <= radius)
+        order = hits[np.argsort(distances[hits], kind="stable")]
+        owners = self.owners[order]
+        # keep each owner's first (nearest) point only
+        _, first = np.unique(owners, return_index=True)
+        first.sort()
+        return owners[first].tolist(), distances[order][first].tolist()
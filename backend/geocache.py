@@ -0,0 +1,81 @@
+# Persistent geocoding cache: an in-memory LRU in front of the geocodes table in services.db
+import os
+import re
+import time
+from cache import LRUCache
+from database import pooled_connection
+
+# Seconds before a successful geocode is looked up again (unset = keep forever)
+GEOCODE_TTL = float(os.environ["GEOCODE_TTL"]) if os.environ.get("GEOCODE_TTL") else None
+# Seconds before an address that returned no results is retried
+GEOCODE_NEGATIVE_TTL = float(os.environ.get("GEOCODE_NEGATIVE_TTL", 7 * 24 * 3600))
+
+_memory = LRUCache(maxsize=4096)
+
+
+def normalize_address(address):
+    """
+    Normalizes an address so trivially different spellings share one cache entry.
+    """
+    address = re.sub(r"\s+", " ", address.replace("+", " ")).strip(" ,.;").lower()
+    return address
+
+
+def _is_fresh(coordinates, fetched_at):
+    ttl = GEOCODE_NEGATIVE_TTL if coordinates is None else GEOCODE_TTL
+    return ttl is None or time.time() - fetched_at < ttl
+
+
+def lookup(address):
+    """
+    Looks an address up in the cache.
+
+    Returns:
+        tuple: (hit, coordinates). coordinates is a (lat, lng) tuple, or None for a cached negative result.
+    """
+    key = normalize_address(address)
+    entry = _memory.get(key)
+    if entry is None:
+        with pooled_connection() as conn:
+            row = conn.execute("SELECT lat, lng, fetched_at FROM geocodes WHERE address = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        coordinates = (row[0], row[1]) if row[0] is not None else None
+        entry = (coordinates, row[2])
+        _memory.set(key, entry)
+
+    coordinates, fetched_at = entry
+    if not _is_fresh(coordinates, fetched_at):
+        return False, None
+    return True, coordinates
+
+
+def store(address, coordinates):
+    """
+    Stores a geocoding result. Pass coordinates=None to cache an address that has no results.
+    """
+    key = normalize_address(address)
+    fetched_at = time.time()
+    lat, lng = coordinates if coordinates is not None else (None, None)
+    with pooled_connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO geocodes (address, lat, lng, fetched_at) VALUES (?, ?, ?, ?)",
+            (key, lat, lng, fetched_at)
+        )
+        conn.commit()
+    _memory.set(key, (coordinates, fetched_at))
+
+
+def invalidate(address=None):
+    """
+    Drops one address from the cache, or every cached address when none is given.
+    """
+    with pooled_connection() as conn:
+        if address is None:
+            conn.execute("DELETE FROM geocodes")
+            _memory.clear()
+        else:
+            key = normalize_address(address)
+            conn.execute("DELETE FROM geocodes WHERE address = ?", (key,))
+            _memory.pop(key)
+        conn.commit()
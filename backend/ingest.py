@@ -0,0 +1,137 @@
+# Background ingestion: syncs Google Sheets and Places into services.db so requests can be served locally
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from database import create_table
+from map import find_places_sync, query_dict
+from spreadsheet import get_snapshot, SHEET_NAME, SHEET_KEY_PATH
+import store
+import sharedcache
+
+log = logging.getLogger(__name__)
+
+# Seconds between ingestion runs
+INGEST_INTERVAL = float(os.environ.get("INGEST_INTERVAL", 15 * 60))
+# Places results not seen for this long are dropped from the store (seconds)
+PLACES_RETENTION = float(os.environ.get("PLACES_RETENTION", 24 * 3600))
+# Areas pre-fetched from Places, as a JSON list of [lat, lng, radius_meters]
+INGEST_CELLS = json.loads(os.environ.get("INGEST_CELLS", "[[42.3601, -71.0589, 8000]]"))  # Boston
+
+# When several worker processes run ingestion, the last run's time is shared so only one of them
+# runs it per interval
+_runs = sharedcache.SharedCache("ingest", max_entries=1) if sharedcache.SHARED_CACHE_ENABLED else None
+
+
+def ingest_sheet():
+    """
+    Pulls the sheet (geocoding new addresses through the cache) and upserts every row.
+    """
+    started = time.time()
+    snapshot = get_snapshot(SHEET_NAME, SHEET_KEY_PATH)
+    if not snapshot.refresh():
+        log.warning("Sheet refresh failed; keeping stored sheet services")
+        return
+    store.upsert_services(snapshot.services, fetched_at=started)
+    # rows deleted from the sheet
+    store.prune(store.SHEET_SOURCE, fetched_before=started)
+
+
+def ingest_places(cells=INGEST_CELLS):
+    """
+    Searches every query_dict category over each coverage cell and upserts the results.
+    """
+    categories = list(query_dict)
+    for lat, lng, radius in cells:
+        store.upsert_services(find_places_sync(categories, lat, lng, radius))
+    # places that have not come back for a while; transient search failures don't delete anything
+    store.prune(store.PLACES_SOURCE, fetched_before=time.time() - PLACES_RETENTION)
+
+
+def run_once():
+    start = time.time()
+    ingest_sheet()
+    ingest_places()
+    log.info("Ingestion took %.2fs", time.time() - start)
+
+
+class IngestWorker:
+    """
+    Runs run_once on a background thread every interval seconds. Every uvicorn worker with
+    INGEST_ENABLED has one; through the shared cache, one of them runs each interval's sweep and
+    the others skip it (without the shared cache, each of them runs it).
+    """
+
+    def __init__(self, interval=INGEST_INTERVAL):
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="ingest")
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_shared(self):
+        """
+        Runs run_once unless another process is running it or ran it less than an interval ago.
+
+        Returns:
+            bool: Whether this process ran it.
+        """
+        with sharedcache.lock("ingest", lease=self.interval, timeout=0) as acquired:
+            if not acquired or self._ran_recently():
+                log.debug("Ingestion skipped; another worker ran it")
+                return False
+            run_once()
+            self._mark_ran()
+            return True
+
+    def _ran_recently(self):
+        if _runs is None:
+            return False
+        try:
+            return _runs.get("last_run") is not None
+        except sqlite3.Error as e:
+            log.warning("Could not read the last ingestion run: %s", e)
+            return False
+
+    def _mark_ran(self):
+        if _runs is None:
+            return
+        try:
+            # a little under the interval, so a timer that fires right on time is not skipped
+            _runs.set("last_run", time.time(), ttl=self.interval * 0.9)
+        except sqlite3.Error as e:
+            log.warning("Could not record the ingestion run: %s", e)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_shared()
+            except Exception as e:
+                log.exception("Ingestion failed: %s", e)
+            self._stopped.wait(self.interval)
+
+
+def main():
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    create_table()
+    if "--once" in sys.argv:
+        run_once()
+        return
+    worker = IngestWorker()
+    worker._run()
+
+if __name__ == "__main__":
+    main()
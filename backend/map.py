@@ -1,6 +1,37 @@
-import requests
-import json
+import asyncio
+import httpx
+import logging
+import os
 from service import Service
+import geocache
+import time
+from sharedcache import TieredCache
+from dedup import ServiceDeduper
+from geo import snap_to_grid
+from singleflight import SingleFlight
+import metrics
+import clients
+
+log = logging.getLogger(__name__)
+
+# Google Maps endpoint; pointed at a local stand-in by the benchmarks
+GOOGLE_MAPS_BASE_URL = os.environ.get("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com")
+# Maximum number of Places requests in flight at once
+PLACES_MAX_CONCURRENCY = int(os.environ.get("PLACES_MAX_CONCURRENCY", 16))
+
+# Text searches are cached per keyword and grid cell, place details per place_id
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 3600))
+DETAILS_CACHE_TTL = float(os.environ.get("DETAILS_CACHE_TTL", 7 * 24 * 3600))
+# Size of the grid cell searches are snapped to (degrees, ~1.1 km) and the radius step (meters)
+SEARCH_CELL_DEGREES = 0.01
+SEARCH_RADIUS_STEP = 500
+
+# Both caches are shared by the worker processes on the host, so a search one worker made is not repeated by the others
+_search_cache = TieredCache("places_search", maxsize=2048, ttl=SEARCH_CACHE_TTL)
+_details_cache = TieredCache("place_details", maxsize=8192, ttl=DETAILS_CACHE_TTL, shared_max_entries=50000)
+# Concurrent cache misses for the same search or place share one upstream call
+_search_flight = SingleFlight("places_search")
+_details_flight = SingleFlight("place_details")
 
 
 # A dictionary with these keys: Education, Legal, Housing/Shelter, Healthcare, Food, Employment, Community Education, Cash Assistance, Mental Health Services, Case Management
@@ -17,73 +48,189 @@ query_dict = {
     "Case Management": ["case management", "evaluations for asylum cases", "immigration law"]
 }
 
-def load_secrets():
-    with open("secrets.json") as secrets_file:
-        return json.load(secrets_file)
-
-# returns list of services that are unique, based on coordinates
+# returns list of services that are unique, based on ID, name and coordinates
 def remove_duplicates(sheets_services, query_services):
-    # merge the two lists and then check the coordinates field for duplicates
-    merged_services = []
     # choose all sheets services
+    deduper = ServiceDeduper()
+    merged_services = []
     for service in sheets_services:
+        deduper.add(service)
         merged_services.append(service)
 
-    # add if the coordinates are not in merged services, url is not false
+    # add query services that are new and have an ID (url)
     for service in query_services:
-        if service.coordinates[0][0] not in [s.coordinates[0][0] for s in merged_services] and service.coordinates[0][1] not in [s.coordinates[0][1] for s in merged_services] and service.ID:
+        if service.ID and deduper.add_if_new(service):
             merged_services.append(service)
 
     return merged_services
-    
 
-    
-def get_place_details(place_id):
-    secrets = load_secrets()
-    api_key = secrets["GOOGLE_API_KEY"]
-    url = f"https://maps.googleapis.com/maps/api/place/details/json"
+# GET a Google Maps URL on the shared blocking client, timing it as a stage; returns None if the call failed
+def _get(stage, url, **kwargs):
+    with metrics.stage(stage):
+        try:
+            response = clients.get(url, **kwargs)
+        except httpx.HTTPError as e:
+            log.warning("Request failed: %s", e)
+            metrics.upstream(stage, "error")
+            return None
+    metrics.upstream(stage, "ok" if response.status_code == 200 else "error")
+    return response
+
+# Async version of _get; the semaphore bounds how many Places calls are in flight
+async def _aget(client, semaphore, stage, url, **kwargs):
+    async with semaphore:
+        with metrics.stage(stage):
+            try:
+                response = await clients.aget(client, url, **kwargs)
+            except httpx.HTTPError as e:
+                log.warning("Request failed: %s", e)
+                metrics.upstream(stage, "error")
+                return None
+    metrics.upstream(stage, "ok" if response.status_code == 200 else "error")
+    return response
+
+async def get_place_details(client, semaphore, place_id):
+    cached = await _details_cache.aget(place_id)
+    metrics.cache_result("place_details", cached is not None)
+    if cached is not None:
+        return cached
+    return await _details_flight.do(place_id, _fetch_place_details, client, semaphore, place_id)
+
+async def _fetch_place_details(client, semaphore, place_id):
+    api_key = clients.google_api_key()
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/details/json"
     params = {
         "place_id": place_id,
         "fields": "name,formatted_address,geometry,opening_hours,website,formatted_phone_number,editorial_summary,url",
         "key": api_key
     }
     
-    response = requests.get(url, params=params)
+    response = await _aget(client, semaphore, "place_details", url, params=params)
+    if response is None:
+        return {}
     if response.status_code == 200:
-        return response.json().get('result', {})
+        details = response.json().get('result', {})
+        if details:
+            _details_cache.set_later(place_id, details)
+        return details
     else:
-        print("Error:", response.status_code)
+        log.warning("Error: %s", response.status_code)
         return {}
 
-# Query a service type and return a list of locations that match
-def find_places(query, lat, lng, radius):
-    if query in query_dict:
-        keywords = query_dict[query]
+# Snap a search to its grid cell so nearby map centers share one cached search
+def search_cell(lat, lng, radius):
+    return snap_to_grid(lat, lng, radius, SEARCH_CELL_DEGREES, SEARCH_RADIUS_STEP)
 
-    secrets = load_secrets()
-    api_key = secrets["GOOGLE_API_KEY"]
-    services = []
+# Run one text search and return the place_ids it found, or None if the search failed
+async def search_keyword(client, semaphore, keyword, lat, lng, radius):
+    lat, lng, radius = search_cell(lat, lng, radius)
+    key = (keyword, lat, lng, radius)
+    cached = await _search_cache.aget(key)
+    metrics.cache_result("places_search", cached is not None)
+    if cached is not None:
+        return cached
+    return await _search_flight.do(key, _fetch_search, client, semaphore, key)
 
-    for keyword in keywords:
-        url = f"https://maps.googleapis.com/maps/api/place/textsearch/json?query={keyword}&location={lat},{lng}&radius={radius}&key={api_key}"
-        print(keyword)
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            if data['status'] == 'OK':
-                for place in data['results']:
-                    place_id = place['place_id']
-                    place_details = get_place_details(place_id)
-                    if place_details:
-                        # Directly map place_details to service
-                        service = map_to_service(place_details, query)
-                        services.append(service)
-            else:
-                print("Error:", data['status'])
+async def _fetch_search(client, semaphore, key):
+    keyword, lat, lng, radius = key
+    api_key = clients.google_api_key()
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/textsearch/json"
+    params = {"query": keyword, "location": f"{lat},{lng}", "radius": radius, "key": api_key}
+    response = await _aget(client, semaphore, "places_search", url, params=params)
+    if response is None:
+        return None
+    if response.status_code == 200:
+        data = response.json()
+        if data['status'] in ('OK', 'ZERO_RESULTS'):
+            place_ids = [place['place_id'] for place in data.get('results', [])]
+            _search_cache.set_later(key, place_ids)
+            return place_ids
         else:
-            print("Request failed:", response.status_code)
+            log.warning("Error: %s", data['status'])
+    else:
+        log.warning("Request failed: %s", response.status_code)
+    return None
+
+# Query one or more service types and return a list of locations that match
+async def find_places(query, lat, lng, radius, client=None):
+    services = []
+    async for batch in iter_places(query, lat, lng, radius, client):
+        services.extend(batch)
     return services
 
+# Blocking version of find_places for background jobs that don't run an event loop
+def find_places_sync(query, lat, lng, radius):
+    async def run():
+        async with clients.new_async_http_client() as client:
+            return await find_places(query, lat, lng, radius, client)
+    return asyncio.run(run())
+
+# Same as find_places, but yields each batch of services as soon as its detail lookups finish
+async def iter_places(query, lat, lng, radius, client=None):
+    client = client or clients.async_http_client()
+    semaphore = asyncio.Semaphore(PLACES_MAX_CONCURRENCY)
+    categories = [query] if isinstance(query, str) else list(query)
+    # categories share keywords (e.g. "immigration law"); search each keyword once
+    keyword_categories = {}
+    for category in categories:
+        for keyword in query_dict.get(category, []):
+            keyword_categories.setdefault(keyword, []).append(category)
+
+    # all keyword searches run at once; each one's detail lookups are queued as soon as it returns
+    searches = {
+        asyncio.ensure_future(search_keyword(client, semaphore, keyword, lat, lng, radius)): keyword
+        for keyword in keyword_categories
+    }
+    details = {}  # task -> place_id
+    place_categories = {}  # place_id -> categories whose keywords found it
+    pending = set(searches)
+    deadline = time.monotonic() + clients.HTTP_TIMEOUT * 2
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # keep whatever has come back so far
+                log.warning("Places calls timed out: %d", len(pending))
+                break
+
+            batch = []
+            for task in done:
+                if task in searches:
+                    try:
+                        place_ids = task.result()
+                    except Exception as e:
+                        log.warning("Search failed: %s", e)
+                        continue
+                    # the same place comes back for several keywords; fetch its details once
+                    for place_id in place_ids or []:
+                        if place_id not in place_categories:
+                            place_categories[place_id] = []
+                            detail_task = asyncio.ensure_future(get_place_details(client, semaphore, place_id))
+                            details[detail_task] = place_id
+                            pending.add(detail_task)
+                        for category in keyword_categories[searches[task]]:
+                            if category not in place_categories[place_id]:
+                                place_categories[place_id].append(category)
+                        # in the requested order, whichever keyword search finished first
+                        place_categories[place_id].sort(key=categories.index)
+                else:
+                    try:
+                        place_details = task.result()
+                    except Exception as e:
+                        log.warning("Details failed: %s", e)
+                        continue
+                    if place_details:
+                        # servicetype is the place's shared category list, so categories found by
+                        # keywords that finish later still show up on this service
+                        batch.append(map_to_service(place_details, place_categories[details[task]]))
+            if batch:
+                yield batch
+    finally:
+        # timed out, or the caller stopped early (e.g. a streaming client disconnected)
+        for task in pending:
+            task.cancel()
+
 # Helper function for class builder, maps the json data to a service object
 def map_to_service(place_data, query):
     return Service(
@@ -106,31 +253,47 @@ def map_to_service(place_data, query):
 
 
 def get_coordinates(location):
+    # answer from the geocode cache when we can, including cached "no results"
+    hit, coordinates = geocache.lookup(location)
+    metrics.cache_result("geocode", hit)
+    if hit:
+        return coordinates
+
+    status, coordinates = geocode(location)
+    # only cache definitive answers; quota and network errors should be retried
+    if status in ("OK", "ZERO_RESULTS"):
+        geocache.store(location, coordinates)
+    return coordinates
+
+def geocode(location):
     location = location.replace(" ", "+")
-    secrets = load_secrets()
-    api_key = secrets["GOOGLE_API_KEY"]
-    url = f"https://maps.googleapis.com/maps/api/geocode/json?address={location}&key={api_key}"
-    
-    response = requests.get(url)
+    api_key = clients.google_api_key()
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/geocode/json?address={location}&key={api_key}"
     
+    response = _get("geocode", url)
+    if response is None:
+        return None, None
+
     if response.status_code == 200:
         data = response.json()
         if data['status'] == 'OK':
             coordinates = data['results'][0]['geometry']['location']
-            return coordinates['lat'], coordinates['lng']
+            return data['status'], (coordinates['lat'], coordinates['lng'])
         else:
-            print("Error:", data['status'])
+            log.warning("Error: %s", data['status'])
+            return data['status'], None
     else:
-        print("Request failed:", response.status_code)
+        log.warning("Request failed: %s", response.status_code)
+        return None, None
 
 def main():
     lat, lng = 42.3601, -71.0589  # Boston
     radius = 3000  # in meters
     query = "Food"
 
-    services = find_places(query, lat, lng, radius)
+    services = find_places_sync(query, lat, lng, radius)
     for service in services:
-        print(service.__dict__)
+        print(service.to_dict())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,102 @@
+# Process-wide latency histograms and counters, exposed in the Prometheus text format on /metrics
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds (seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_counters = {}  # (name, labels) -> value
+_help = {
+    "stage_duration_seconds": ("histogram", "Time spent in each stage of request handling"),
+    "http_request_duration_seconds": ("histogram", "End-to-end request latency"),
+    "upstream_requests_total": ("counter", "Calls made to Google Sheets, Geocoding and Places"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "singleflight_calls_total": ("counter", "Calls that started work (leader) or joined a call already in flight (shared)"),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """
+    Records one observation in a histogram.
+    """
+    key = _key(name, labels)
+    with _lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+def count(name, amount=1, **labels):
+    """
+    Adds to a counter.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as one stage of request handling.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_duration_seconds", time.perf_counter() - start, stage=name)
+
+
+def upstream(api, outcome="ok"):
+    count("upstream_requests_total", api=api, outcome=outcome)
+
+
+def cache_result(cache, hit):
+    count("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    names = sorted({name for name, _ in histograms} | {name for name, _ in counters})
+    for name in names:
+        kind, description = _help.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, bucket_count in zip(BUCKETS, values):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,59 @@
+# Nearest-first paging for the list endpoints
+import base64
+import heapq
+import json
+import os
+
+# Page size used when a cursor is given without a limit, and the largest page a client may ask for
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 20))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 500))
+
+
+def encode_cursor(distance, item_id):
+    """
+    Encodes the position of the last item on a page as an opaque, URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps([distance, item_id]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor from encode_cursor back into its (distance, ID) position.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        distance, item_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(distance), str(item_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def nearest_page(distances, ids, limit, after=None, radius=None):
+    """
+    Selects one page of items ordered by (distance, ID) without sorting the whole set.
+
+    Items are ranked by distance with the ID as a tie-breaker, so the order is total and a
+    cursor keeps its place even when items are added or removed between requests.
+
+    Args:
+        distances (array-like): Distance in meters of each item.
+        ids (list): String ID of each item.
+        limit (int): Page size.
+        after (tuple): (distance, ID) of the last item on the previous page, as returned by decode_cursor.
+        radius (float): If given, items farther than this are left out.
+
+    Returns:
+        tuple: (indices of the page's items, nearest first; cursor for the next page, or None on the last page)
+    """
+    candidates = ((distance, ids[i], i) for i, distance in enumerate(map(float, distances)))
+    if radius is not None:
+        candidates = (candidate for candidate in candidates if candidate[0] <= radius)
+    if after is not None:
+        candidates = (candidate for candidate in candidates if candidate[:2] > after)
+    # one extra item tells us whether there is a next page
+    top = heapq.nsmallest(limit + 1, candidates)
+    page = top[:limit]
+    next_cursor = encode_cursor(*page[-1][:2]) if len(top) > limit else None
+    return [i for _, _, i in page], next_cursor
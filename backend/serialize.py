@@ -0,0 +1,63 @@
+# Fast JSON encoding for service lists on the response path.
+# Services built by this app (sheet, Places, store and user-input rows) are already trusted, so they
+# are turned straight into plain dicts with the same shape and coercions as models.ServiceModel
+# instead of being validated into pydantic models and re-validated against the response_model.
+import json
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library encoder produces the same JSON, just slower
+    orjson = None
+
+
+def _str(value):
+    # pydantic's str coercion for Optional[str] fields: None stays None, numbers become strings
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def _str_list(values):
+    return [value if isinstance(value, str) else str(value) for value in values]
+
+
+def service_record(service, upvote):
+    """
+    Builds the JSON-ready form of a Service, field for field what ServiceModel would produce.
+
+    Args:
+        service (Service): A sheet, Places or store service.
+        upvote (int): The service's current upvote count.
+
+    Returns:
+        dict: The service in the /services response shape.
+    """
+    servicetype = service.servicetype
+    extrafilters = service.extrafilters
+    languages = service.languages
+    coordinates = service.coordinates
+    return {
+        "ID": str(service.ID),
+        "name": str(service.name),
+        "servicetype": [servicetype] if isinstance(servicetype, str) else _str_list(servicetype),
+        "extrafilters": extrafilters.split(', ') if isinstance(extrafilters, str) else _str_list(extrafilters or []),
+        "demographic": _str(service.demographic),
+        "website": _str(service.website),
+        "summary": _str(service.summary),
+        "address": _str_list(service.address),
+        "coordinates": None if coordinates is None else list(coordinates),
+        "neighborhoods": _str(service.neighborhoods),
+        "hours": _str(service.hours),
+        "phone": _str(service.phone),
+        "languages": [languages] if isinstance(languages, str) else _str_list(languages or []),
+        "googlelink": _str(service.googlelink),
+        "source": str(service.source),
+        "upvote": upvote,
+    }
+
+
+def dumps(value):
+    """
+    Encodes a JSON-ready value (as built by service_record) to compact UTF-8 JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
@@ -1,17 +1,54 @@
-from fastapi import FastAPI, HTTPException
-from spreadsheet import fetch_and_process_spreadsheet_data, hash_organization_name
-from map import find_places
-from typing import List
-from database import create_connection, get_upvote_by_id, create_table
+from fastapi import FastAPI, HTTPException, Query, Path
+from spreadsheet import fetch_and_process_spreadsheet_data, hash_organization_name, get_snapshot, SHEET_NAME, SHEET_KEY_PATH, SHEET_CHANGE_KIND
+from map import find_places, iter_places
+from typing import List, Optional
+from database import pooled_connection, get_upvote_by_id, get_upvotes, create_table, get_services_in_box, insert_service, insert_new_services
+from database import get_change_version, get_changes, get_services_by_id
 import json
 from models import ServiceModel, ServiceInput, ReviewModel
 from starlette.middleware.cors import CORSMiddleware
-import ast
-import math
+from starlette.responses import StreamingResponse, Response
+from dedup import ServiceDeduper
+from geo import PointSet
 from models import ServiceModel, ReviewModel, ServiceInput
 from map import remove_duplicates
-
-
+from upvotes import record_upvote, with_pending, start_writer, stop_writer
+from ingest import IngestWorker
+import store
+import os
+import time
+import hashlib
+import logging
+import metrics
+import clients
+import asyncio
+from blocking import run_blocking
+from geo import snap_to_grid
+from singleflight import SingleFlight
+from serialize import service_record, dumps
+from pagination import nearest_page, decode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from fulltext import TextIndex, fts_query
+from bulk import parse_rows, parse_coordinates, validate_rows, geocode_missing, MAX_IMPORT_ROWS
+import tiles
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+# Run the ingestion worker inside this process (with several workers, one runs each sweep)
+INGEST_ENABLED = os.environ.get("INGEST_ENABLED", "0") == "1"
+# Serve /services from the ingested local store instead of calling Google on the request path
+SERVE_FROM_STORE = os.environ.get("SERVE_FROM_STORE", "0") == "1"
+# Concurrent /services searches whose centers fall in the same grid cell (degrees, ~55 m) and whose
+# radii round up to the same step (meters) share one computation
+COALESCE_CELL_DEGREES = float(os.environ.get("COALESCE_CELL_DEGREES", 0.0005))
+COALESCE_RADIUS_STEP = float(os.environ.get("COALESCE_RADIUS_STEP", 50))
+# Deepest map zoom level served by /tiles
+MAX_TILE_ZOOM = 22
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+log = logging.getLogger(__name__)
+
+ingest_worker = IngestWorker()
+services_flight = SingleFlight("services")
 
 app = FastAPI()
 # Allow CORS for all origins (not recommended for production)
@@ -21,121 +58,329 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "ETag"],  # Lets the frontend read the paging cursor and the ETag
 )
 
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # label by route template, not the raw path, so /reviews/{review_id} is one series
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.observe("http_request_duration_seconds", time.perf_counter() - start,
+                    method=request.method, path=path, status=response.status_code)
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.on_event("startup")
 async def startup_event():
     create_table()
+    # secrets and pooled HTTP clients are set up once and shared by every request
+    clients.startup()
+    if not SERVE_FROM_STORE:
+        # warm the spreadsheet snapshot so the first search doesn't wait on Google Sheets
+        get_snapshot(SHEET_NAME, SHEET_KEY_PATH).refresh_async()
+    if INGEST_ENABLED:
+        ingest_worker.start()
+    start_writer()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await clients.shutdown()
+    ingest_worker.stop()
+    # write out any buffered upvotes before the process exits
+    stop_writer()
+
+def parse_categories(query: List[str]) -> List[str]:
+    # accept repeated query parameters and comma-separated lists, keeping the first occurrence of each
+    categories = []
+    for value in query:
+        for category in value.split(","):
+            category = category.strip()
+            if category and category not in categories:
+                categories.append(category)
+    return categories
+
+# List endpoints return pre-encoded JSON; response_model still documents the shape in the OpenAPI schema.
+# When the list is paged, the cursor for the next page is sent in the X-Next-Cursor header.
+# Given the request, the response carries an ETag (by default a hash of the body), and a client that
+# sends it back in If-None-Match gets an empty 304 while the list is unchanged.
+def json_response(body: bytes, next_cursor: Optional[str] = None, request: Optional[Request] = None,
+                  etag: Optional[str] = None) -> Response:
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if request is not None:
+        etag = etag or body_etag(body)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        headers["ETag"] = etag
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def body_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+# ETag for a result that depends only on stored services and upvotes: it changes with every stored
+# change, so a request can be answered with a 304 before running the query. (Upvotes buffered by the
+# write-behind writer show up once they are flushed.)
+def version_etag(version: int, *params) -> str:
+    return f'"v{version}-' + hashlib.blake2b(repr(params).encode(), digest_size=8).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def page_params(limit: Optional[int], cursor: Optional[str]):
+    # no limit and no cursor means the whole, unpaged list
+    if cursor is None:
+        return limit, None
+    try:
+        after = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return limit or DEFAULT_PAGE_SIZE, after
+
+
+def encode(records: List[dict]) -> bytes:
+    with metrics.stage("json_encode"):
+        return dumps(records)
+
 
 @app.get("/services", response_model=List[ServiceModel])
-#fix it so that it can take multiple query parameters
-async def get_combined_services(query: str, lat: float, lng: float, radius: float):
+async def get_combined_services(request: Request, lat: float, lng: float, radius: float, query: List[str] = Query(...),
+                                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                                search: Optional[str] = None):
     # Convert miles to meters
     radius = radius * 1609.34
-
-    spreadsheet_services = fetch_and_process_spreadsheet_data(
-        'UrbanRefugeAidServices', 
-        'balmy-virtue-440518-c9-1dbeaecb35aa.json',
-        lat,
-        lng,
-        radius,
-        query
-    )
-    places_services = find_places(query, lat, lng, radius)
-    combined_services = remove_duplicates(spreadsheet_services, places_services)
-
-    services_dict = [
-        ServiceModel(
-            servicetype=[service.servicetype] if isinstance(service.servicetype, str) else service.servicetype,
-            extrafilters=service.extrafilters.split(', ') if isinstance(service.extrafilters, str) else (service.extrafilters or []),
-            languages=[service.languages] if isinstance(service.languages, str) else (service.languages or []),
-            googlelink=str(service.googlelink) if isinstance(service.googlelink, bool) else service.googlelink,
-            upvote=get_upvote_by_id(str(hash_organization_name(service.name))),
-            **{k: v for k, v in vars(service).items() if k not in {'servicetype', 'extrafilters', 'languages', 'googlelink', 'upvote'}}
+    # several categories are served from one sheet snapshot and one search per unique keyword
+    categories = parse_categories(query)
+    limit, after = page_params(limit, cursor)
+    # keywords narrow the results to matching services, best match first
+    match = fts_query(search)
+    # near-identical searches are answered for the same snapped center and radius, so whichever
+    # request arrives first computes the result the others receive
+    lat, lng, radius = snap_to_grid(lat, lng, radius, COALESCE_CELL_DEGREES, COALESCE_RADIUS_STEP)
+    key = (lat, lng, radius, tuple(sorted(categories)), match, limit, after)
+    etag = None
+    if SERVE_FROM_STORE:
+        # everything comes from services.db, so an unchanged list is detected without searching
+        etag = version_etag(await run_blocking(get_change_version), "services", *key)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    # coalesced requests share the encoded body, not just the services
+    body, next_cursor = await services_flight.do(key, search_services, lat, lng, radius, categories, match, limit, after)
+    return json_response(body, next_cursor, request, etag)
+
+
+async def search_services(lat: float, lng: float, radius: float, categories: List[str], match: Optional[str] = None,
+                          limit: Optional[int] = None, after=None):
+    if SERVE_FROM_STORE:
+        services = await run_blocking(store.find_services, lat, lng, radius, categories, match)
+        return await run_blocking(encode_page, services, lat, lng, limit, after)
+
+    # the sheet (blocking, on the executor) and Places (async) are fetched at the same time, so
+    # they are timed together; sheet_fetch and the Places API stages break the time down
+    with metrics.stage("upstream_fetch"):
+        spreadsheet_services, places_services = await asyncio.gather(
+            run_blocking(fetch_and_process_spreadsheet_data, SHEET_NAME, SHEET_KEY_PATH, lat, lng, radius, categories, match),
+            find_places(categories, lat, lng, radius)
         )
-        for service in combined_services
-    ]
-    
-    return services_dict
-
-
-# Helper function to parse JSON fields from a database row
-def parse_service_row(row: dict) -> ServiceModel:
-    # Ensure coordinates are parsed as a tuple from string format
-    if 'coordinates' in row:
-        coordinates_str = row['coordinates']
-        # Safely convert the string representation to a tuple
-        coordinates = tuple(ast.literal_eval(coordinates_str))
+    # Places lookups finish in any order; a fixed order keeps the body (and its ETag) stable
+    places_services = nearest_first(places_services, lat, lng)
+    if match is not None:
+        # Places results are live, so they are matched against a throwaway index with the same ranking
+        with metrics.stage("text_search"):
+            places_services = await run_blocking(TextIndex.match, places_services, match)
+    with metrics.stage("dedup"):
+        combined_services = remove_duplicates(spreadsheet_services, places_services)
+
+    return await run_blocking(encode_page, combined_services, lat, lng, limit, after)
+
+
+# Sorts services by distance to (lat, lng), then by ID
+def nearest_first(services, lat: float, lng: float):
+    distances = PointSet.from_coordinates([service.coordinates for service in services]).owner_distances(lat, lng, len(services))
+    order = sorted(range(len(services)), key=lambda i: (distances[i], str(services[i].ID)))
+    return [services[i] for i in order]
+
+
+# Encodes the services, or one nearest-first page of them if limit is set; returns (body, next cursor)
+def encode_page(services, lat: float, lng: float, limit: Optional[int] = None, after=None):
+    next_cursor = None
+    if limit is not None:
+        with metrics.stage("pagination"):
+            points = PointSet.from_coordinates([service.coordinates for service in services])
+            distances = points.owner_distances(lat, lng, len(services))
+            indices, next_cursor = nearest_page(distances, [str(service.ID) for service in services], limit, after)
+            services = [services[i] for i in indices]
+    return encode(to_service_records(services)), next_cursor
+
+
+# Helper function to convert Service objects into response records, resolving their upvotes in one query
+def to_service_records(services) -> List[dict]:
+    with metrics.stage("upvote_lookup"):
+        upvotes = with_pending(get_upvotes(str(hash_organization_name(service.name)) for service in services))
+
+    with metrics.stage("serialization"):
+        return [service_record(service, upvotes[str(hash_organization_name(service.name))]) for service in services]
+
+
+# Streaming variant of /services: newline-delimited JSON, one service per line.
+# Sheet results are written first, then Places results as each batch of lookups finishes.
+@app.get("/services/stream")
+async def stream_combined_services(lat: float, lng: float, radius: float, query: List[str] = Query(...)):
+    radius = radius * 1609.34
+    categories = parse_categories(query)
+
+    async def generate():
+        if SERVE_FROM_STORE:
+            # everything is local, so there is nothing to wait for between lines
+            records = await run_blocking(lambda: to_service_records(store.find_services(lat, lng, radius, categories)))
+            for record in records:
+                yield dumps(record) + b"\n"
+            return
+
+        deduper = ServiceDeduper()
+        spreadsheet_services = await run_blocking(
+            fetch_and_process_spreadsheet_data, SHEET_NAME, SHEET_KEY_PATH, lat, lng, radius, categories
+        )
+        for service in spreadsheet_services:
+            deduper.add(service)
+        for record in await run_blocking(to_service_records, spreadsheet_services):
+            yield dumps(record) + b"\n"
+
+        async for batch in iter_places(categories, lat, lng, radius):
+            # drop anything already written, including duplicates within this batch
+            new_services = [service for service in batch if service.ID and deduper.add_if_new(service)]
+            for record in await run_blocking(to_service_records, new_services):
+                yield dumps(record) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+# Endpoint for the map: the services in one z/x/y map tile (the usual web map tile scheme), as
+# clusters with counts up to zoom level CLUSTER_MAX_ZOOM and as lightweight points above it or
+# where a cell holds a single service. query optionally filters by category, as for /services.
+# Tiles hold the stored services: with SERVE_FROM_STORE, everything /services returns (sheet and
+# ingested Places); otherwise user-added locations and the sheet snapshot only, since live Places
+# results are fetched per search and are not indexed, so the map still needs /services for them.
+@app.get("/tiles/{z}/{x}/{y}")
+async def get_tile(request: Request, z: int = Path(..., ge=0, le=MAX_TILE_ZOOM), x: int = Path(..., ge=0),
+                   y: int = Path(..., ge=0), query: List[str] = Query([])):
+    if x >= 2 ** z or y >= 2 ** z:
+        raise HTTPException(status_code=400, detail=f"Tile {x}/{y} is outside zoom level {z}")
+    categories = parse_categories(query)
+
+    def tile():
+        # with SERVE_FROM_STORE every stored source; otherwise user input and the sheet, not Places
+        if SERVE_FROM_STORE:
+            tiles.sync()
+        else:
+            tiles.sync(stored_sources=("User Input",), sheet=True)
+        with metrics.stage("tile"):
+            return dumps(tiles.index.tile(z, x, y, categories))
+    return json_response(await run_blocking(tile), request=request)
+
+
+# Helper function to parse JSON fields from a database row into a response record (rows were validated on insert)
+def parse_service_row(row: dict, upvote: int = 0) -> dict:
+    # Location comes from the typed lat/lng columns
+    if row.get('lat') is not None and row.get('lng') is not None:
+        coordinates = [row['lat'], row['lng']]
     else:
-        coordinates = ()
-
-    service = ServiceModel(
-        ID= str(row['ID']),
-        name=row['name'],
-        coordinates=coordinates, 
-        servicetype=json.loads(row["services"]) if row.get("services") else [],  
-        extrafilters=None, 
-        demographic=None, 
-        website=row["website"] if row.get("website") else None,
-        summary=row["notes"] if row.get("notes") else None,
-        address=[row["addr"]] if row.get("addr") else [],  
-        neighborhoods=None, 
-        hours=row["hours"] if row.get("hours") else None,
-        phone=row["phone"] if row.get("phone") else None,
-        languages=json.loads(row["languages"]) if row.get("languages") else [], 
-        googlelink=None, 
-        source="User Input",
-        upvote=get_upvote_by_id(str(row['ID']))
-    )
-    return service
+        coordinates = []
+
+    return {
+        "ID": str(row['ID']),
+        "name": str(row['name']),
+        "servicetype": json.loads(row["servicetype"]) if row.get("servicetype") else [],
+        "extrafilters": None,
+        "demographic": None,
+        "website": row["website"] if row.get("website") else None,
+        "summary": row["summary"] if row.get("summary") else None,
+        "address": json.loads(row["address"]) if row.get("address") else [],
+        "coordinates": coordinates,
+        "neighborhoods": None,
+        "hours": row["hours"] if row.get("hours") else None,
+        "phone": row["phone"] if row.get("phone") else None,
+        "languages": json.loads(row["languages"]) if row.get("languages") else [],
+        "googlelink": None,
+        "source": "User Input",
+        "upvote": upvote
+    }
 
 
 # Endpoint for displaying user input data
 @app.get("/locations/", response_model=List[ServiceModel])
-async def get_all_services(lat: float, lng: float, radius: float):
+async def get_all_services(request: Request, lat: float, lng: float, radius: float, category: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           search: Optional[str] = None):
     radius = radius * 1609.34
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM services")  
-    rows = cursor.fetchall()
-    conn.close()
-
-    services = [
-        parse_service_row(dict(zip([column[0] for column in cursor.description], row)))
-        for row in rows
-    ]
-
-    filtered_services = []
-    for service in services:
-        if service.coordinates and len(service.coordinates) == 2:
-            service_lat = float(service.coordinates[0])  
-            service_lng = float(service.coordinates[1])  
-            print(type(service_lat), type(service.coordinates[0]), service.coordinates[0])
-            distance = calculate_distance(lat, lng, service_lat, service_lng)
-
-            if distance <= radius:
-                filtered_services.append(service)
+    limit, after = page_params(limit, cursor)
+    match = fts_query(search)
+    etag = version_etag(await run_blocking(get_change_version), "locations", lat, lng, radius, category, limit, after, match)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    def page():
+        records, next_cursor = find_locations(lat, lng, radius, category, limit, after, match)
+        return encode(records), next_cursor
+    body, next_cursor = await run_blocking(page)
+    return json_response(body, next_cursor, request, etag)
+
+
+# Stored user-submitted services within radius meters, nearest first (blocking; runs on the executor).
+# With a limit, only one page is selected and the cursor for the next page is returned with it.
+# With an FTS5 search query, only matching services are returned, best match first unless paged.
+def find_locations(lat: float, lng: float, radius: float, category: Optional[str] = None,
+                   limit: Optional[int] = None, after=None, search: Optional[str] = None):
+    # only rows inside the query's bounding box (and of the category, if given) are parsed and distance-checked
+    with metrics.stage("spatial_query"):
+        rows = get_services_in_box(lat, lng, radius, category, sources=("User Input",), search=search)
+
+    located = []
+    for row in rows:
+        if row.get('lat') is not None and row.get('lng') is not None:
+            located.append(row)
         else:
-            print(f"Service {service.name} has invalid coordinates: {service.coordinates}")
-
-    return filtered_services
-
-def calculate_distance(lat1, lon1, lat2, lon2):
-    # Radius of the Earth in kilometers
-    R = 6371.0
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+            log.debug("Service %s has no coordinates", row['name'])
+
+    # exact distance check for every candidate in one vectorized pass, nearest first
+    next_cursor = None
+    with metrics.stage("distance_filter"):
+        points = PointSet.from_coordinates([[(row['lat'], row['lng'])] for row in located])
+        if limit is None:
+            owners, _ = points.within(lat, lng, radius)
+            if search is not None:
+                # rows come back in rank order; keep it instead of nearest first
+                owners.sort()
+        else:
+            distances = points.owner_distances(lat, lng, len(located))
+            owners, next_cursor = nearest_page(distances, [str(row['ID']) for row in located], limit, after, radius)
+        rows = [located[owner] for owner in owners]
 
-    return R * c * 1000  # Return distance in meters
+    # upvotes and parsing only for the rows actually returned
+    with metrics.stage("upvote_lookup"):
+        upvotes = with_pending(get_upvotes(str(row['ID']) for row in rows))
+    with metrics.stage("serialization"):
+        return [parse_service_row(row, upvotes[str(row['ID'])]) for row in rows], next_cursor
 
 
 # Endpoint for users to input data
@@ -144,15 +389,24 @@ async def add_service(service_input: ServiceInput):
     # Generate unique ID for the service
     service_id = hash(service_input.name)  # You can customize this ID generation
 
-    # Validate that coordinates contain two valid floats
+    # Validate that coordinates are two numbers in range, as for bulk imports
     try:
-        coordinates = tuple(service_input.coordinates)  # Tuple of floats
+        coordinates = parse_coordinates(service_input.coordinates)
     except ValueError as e:
-        raise HTTPException(status_code=400, detail="Invalid coordinates format")
+        raise HTTPException(status_code=400, detail=f"Invalid coordinates: {e}")
+    if coordinates is None:
+        raise HTTPException(status_code=400, detail="Invalid coordinates: coordinates must be [lat, lng]")
+
+    service = service_from_input(service_input, coordinates, await run_blocking(get_upvote_by_id, str(service_id)))
 
-    # Create an instance of ServiceModel with the input data
-    service = ServiceModel(
-        ID= str(service_id),
+    await run_blocking(store_service, service)
+    return {"message": "Service added successfully"}
+
+
+# Create an instance of ServiceModel with the input data
+def service_from_input(service_input: ServiceInput, coordinates, upvote: int) -> ServiceModel:
+    return ServiceModel(
+        ID= str(hash(service_input.name)),  # You can customize this ID generation
         name=service_input.name,
         servicetype=service_input.services,  # Map 'services' to 'servicetype'
         extrafilters=None,  # Handle as needed
@@ -161,88 +415,173 @@ async def add_service(service_input: ServiceInput):
         neighborhoods=None,  # Handle as needed
         hours=service_input.hours,
         phone=service_input.phone,
-        languages=service_input.languages,
+        languages=service_input.languages or [],
         website=service_input.website,
         summary=service_input.notes,  # Assuming 'notes' maps to 'summary'
         demographic=None,  # Handle as needed
         googlelink=None,  # Handle as needed
         source="User Input",
-        upvote = get_upvote_by_id(str(service_id))
+        upvote=upvote
     )
 
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT INTO services (ID, name, servicetype, extrafilters, demographic, website,
-                              summary, address, coordinates, neighborhoods, hours, phone,
-                              languages, googlelink, source, upvote)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''',
-        (
-            service.ID,
-            service.name,
-            json.dumps(service.servicetype), 
-            json.dumps(service.extrafilters) if service.extrafilters is not None else None,
-            service.demographic,
-            service.website,
-            service.summary,
-            json.dumps(service.address),  
-            json.dumps(service.coordinates) if service.coordinates else None, 
-            service.neighborhoods,
-            service.hours,
-            service.phone,
-            json.dumps(service.languages), 
-            service.googlelink,
-            service.source,
-            service.upvote
-        )
-    )
-    conn.commit()
-    conn.close()
-    return {"message": "Service added successfully"}
+
+# Endpoint for partners adding many locations at once: a JSON array of the same objects as
+# POST /locations/, or CSV (Content-Type: text/csv) with those fields as columns. Rows without
+# coordinates are geocoded; rows that fail are reported and the rest are stored.
+@app.post("/locations/bulk")
+async def import_services(request: Request):
+    body = await request.body()
+    try:
+        rows = parse_rows(body, request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) > MAX_IMPORT_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_IMPORT_ROWS} rows per import")
+    return await run_blocking(import_locations, rows)
+
+
+def import_locations(rows: list) -> dict:
+    with metrics.stage("import_validate"):
+        valid, errors = validate_rows(rows)
+    with metrics.stage("import_geocode"):
+        located, geocode_errors = geocode_missing(valid)
+    errors.extend(geocode_errors)
+
+    # one row per name: a name repeated within the batch is reported, not stored twice
+    rows_by_name = {}
+    for index, service_input, coordinates in located:
+        if service_input.name in rows_by_name:
+            errors.append({"row": index, "error": f"Duplicate name in this import: {service_input.name}"})
+        else:
+            rows_by_name[service_input.name] = (index, service_input, coordinates)
+
+    upvotes = get_upvotes(str(hash(name)) for name in rows_by_name)
+    services, rows_by_id = [], {}
+    for index, service_input, coordinates in rows_by_name.values():
+        service = service_from_input(service_input, coordinates, upvotes[str(hash(service_input.name))])
+        services.append(service)
+        rows_by_id[service.ID] = (index, service_input)
+    # names already stored are found in services.db, whichever process stored them
+    with metrics.stage("import_insert"):
+        existing = insert_new_services(services)
+    for service_id in existing:
+        index, service_input = rows_by_id[service_id]
+        errors.append({"row": index, "error": f"A location with this name already exists: {service_input.name}"})
+    tiles.add_stored(service for service in services if service.ID not in existing)
+
+    errors.sort(key=lambda error: error["row"])
+    return {"inserted": len(services) - len(existing), "errors": errors}
+
+
+# Stores one service and adds it to the map tiles (blocking: the tile index may be mid-sync)
+def store_service(service: ServiceModel):
+    with pooled_connection() as conn:
+        insert_service(conn.cursor(), service)
+        conn.commit()
+    tiles.add_stored([service])
+
+
+# Endpoint for delta sync: what changed after version since (0 for everything), oldest first.
+# Each change has its version, an op (insert, update or delete), a kind (service or upvote), the
+# ID and, unless deleted, the current record. Clients pass the returned version as since on the
+# next call; "more" means there are further changes to fetch right away.
+@app.get("/changes")
+async def get_service_changes(since: int = Query(0, ge=0), limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return json_response(await run_blocking(list_changes, since, limit))
+
+
+def list_changes(since: int, limit: int) -> bytes:
+    # read the version first: everything up to it is committed, so nothing below it is skipped
+    version = get_change_version()
+    # the sheet's services are reported as they are served: from the store, or from the sheet snapshot
+    kinds = ("service", "upvote") if SERVE_FROM_STORE else ("service", SHEET_CHANGE_KIND, "upvote")
+    with metrics.stage("changes_query"):
+        rows = get_changes(since, kinds, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        version = rows[-1][0] if more else max(version, rows[-1][0])
+
+    with metrics.stage("changes_records"):
+        live = [(kind, item_id, digest) for _, kind, item_id, _, deleted, digest in rows if not deleted]
+        records = changed_records(live)
+    changes = []
+    for change_version, kind, item_id, created_version, deleted, _ in rows:
+        if deleted:
+            if created_version > since:
+                continue  # created and deleted since the client last synced
+            op = "delete"
+        else:
+            op = "insert" if created_version > since else "update"
+        change = {"version": change_version, "op": op, "kind": "upvote" if kind == "upvote" else "service", "ID": item_id}
+        if not deleted:
+            record = records.get((kind, item_id))
+            if record is None:
+                # deleted after the change was read, or the sheet snapshot is still behind it: stop
+                # here, so the client gets this change (or the delete) when it next syncs from version
+                version = change_version - 1
+                more = False
+                break
+            change["record"] = record
+        changes.append(change)
+    with metrics.stage("json_encode"):
+        return dumps({"version": version, "more": more, "changes": changes})
+
+
+# Current response records for changed (kind, ID, digest) items, keyed by (kind, ID)
+def changed_records(items) -> dict:
+    ids = {}
+    sheet_digests = {}
+    for kind, item_id, digest in items:
+        ids.setdefault(kind, []).append(item_id)
+        if kind == SHEET_CHANGE_KIND:
+            sheet_digests[item_id] = digest
+    records = {}
+
+    rows = get_services_by_id(ids.get("service", []))
+    user_rows = [row for row in rows if row["source"] == "User Input"]
+    upvotes = with_pending(get_upvotes(str(row["ID"]) for row in user_rows))
+    for row in user_rows:
+        records["service", str(row["ID"])] = parse_service_row(row, upvotes[str(row["ID"])])
+    synced = [store.service_from_row(row) for row in rows if row["source"] != "User Input"]
+    for service, record in zip(synced, to_service_records(synced)):
+        records["service", str(service.ID)] = record
+
+    if sheet_digests:
+        sheet_services = sheet_services_at(sheet_digests)
+        for service, record in zip(sheet_services, to_service_records(sheet_services)):
+            records[SHEET_CHANGE_KIND, str(service.ID)] = record
+
+    if "upvote" in ids:
+        upvotes = with_pending(get_upvotes(ids["upvote"]))
+        for review_id, upvote in upvotes.items():
+            records["upvote", review_id] = {"ID": review_id, "upvote": upvote}
+    return records
+
+
+# The sheet services whose content matches the given change digests ({ID: digest}). The changes
+# are recorded by whichever worker downloaded the sheet, so this worker's snapshot can be behind
+# them; it first catches up from the shared copy, and services it still can't match are left out
+def sheet_services_at(digests: dict) -> list:
+    snapshot = get_snapshot(SHEET_NAME, SHEET_KEY_PATH)
+    snapshot.get()
+    current = snapshot.digests()
+    if any(current.get(item_id, (None,))[0] != digest for item_id, digest in digests.items()):
+        snapshot.catch_up()
+        current = snapshot.digests()
+    return [current[item_id][1] for item_id, digest in digests.items()
+            if item_id in current and current[item_id][0] == digest]
 
 
 @app.post("/reviews/")
 async def add_review(review: ReviewModel):
-    conn = create_connection()
-    cursor = conn.cursor()
-        
-    # Check if there are existing entries for this service
-    cursor.execute("SELECT upvote FROM reviews WHERE ID = ?", (review.ID,))
-    row = cursor.fetchone()
-
-    if row:
-        # If the entry exists, increment the upvote count
-        upvote_count = row[0] + 1
-        cursor.execute(
-            "UPDATE reviews SET upvote = ? WHERE ID = ?",
-            (upvote_count, review.ID)
-        )
-    else:
-        # If no entry exists, create a new one with upvote initialized to 1
-        cursor.execute("INSERT INTO reviews (ID, upvote) VALUES (?, ?)", 
-                       (review.ID, 1))
-
-    conn.commit()
-    conn.close()
+    # atomic increment (or buffered, when write-behind is enabled); creates the entry on first upvote
+    await run_blocking(record_upvote, review.ID)
 
     return {"message": "Upvote added successfully"}
 
 @app.get("/reviews/{review_id}", response_model=ReviewModel)
 async def get_review(review_id: str):
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Select ID and upvote from the reviews table for the specific ID
-    cursor.execute("SELECT ID, upvote FROM reviews WHERE ID = ?", (review_id,))
-    row = cursor.fetchone()
-    conn.close()
-    print("ROW ROW ROW",row)
-    # If no review is found, raise a 404 error
-    if row is None:
-        review = ReviewModel(ID=review_id, upvote=0)
-    else:
-        review = ReviewModel(ID=row[0], upvote=row[1])
-    # Create a ReviewModel instance with the retrieved data
-    return review
\ No newline at end of file
+    # includes upvotes still waiting in the write-behind buffer
+    upvote = with_pending(await run_blocking(get_upvotes, [review_id]))[review_id]
+    return ReviewModel(ID=review_id, upvote=upvote)
@@ -1,5 +1,9 @@
 # Define the class for the spreadsheet data
 class Service:
+    # fixed attributes, no per-instance __dict__: the sheet snapshot and every search hold many of these
+    __slots__ = ("ID", "name", "servicetype", "extrafilters", "demographic", "website", "summary", "address",
+                 "coordinates", "neighborhoods", "hours", "phone", "languages", "googlelink", "source")
+
     def __init__(self, ID, name, servicetype, extrafilters, demographic, website, summary, address, coordinates, neighborhoods, hours, phone, languages, googlelink, source):
         self.ID = ID #string
         self.name = name #string
@@ -16,3 +20,6 @@ class Service:
         self.languages = languages #list of strings
         self.googlelink = googlelink #string
         self.source = source #string
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
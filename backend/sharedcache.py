@@ -0,0 +1,289 @@
+# Cache shared by every worker process on the host, kept in its own SQLite file (WAL mode), plus
+# cross-process locks so only one worker refreshes a shared entry from Google at a time
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from cache import LRUCache
+from database import pooled_connection
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Cache file shared by the workers; unset SHARED_CACHE to keep every cache in-process only
+SHARED_CACHE_PATH = os.environ.get("SHARED_CACHE_PATH", "cache.db")
+SHARED_CACHE_ENABLED = os.environ.get("SHARED_CACHE", "1") == "1"
+# Expired and least recently used entries are cleaned up once every this many writes (per process)
+EVICT_EVERY = 256
+# A read refreshes an entry's last-used time at most this often (seconds), so reads rarely write
+TOUCH_INTERVAL = 60
+# Threads for shared cache reads and writes from the event loop, apart from the request handlers' blocking pool
+SHARED_CACHE_WORKERS = 4
+
+_MISSING = object()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_executor = ThreadPoolExecutor(max_workers=SHARED_CACHE_WORKERS, thread_name_prefix="sharedcache")
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (namespace, expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (namespace, accessed_at)")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        conn.commit()
+        _schema_ready = True
+
+
+@contextmanager
+def _connection():
+    with pooled_connection(SHARED_CACHE_PATH) as conn:
+        _ensure_schema(conn)
+        yield conn
+
+
+class SharedCache:
+    """
+    Key-value cache stored in SQLite so every worker process on the host shares one copy.
+    Keys and values must be JSON-serializable.
+
+    Args:
+        namespace (str): Keeps this cache's entries apart from other caches in the same file.
+        ttl (float): Seconds an entry stays valid, or None to keep entries until evicted.
+        max_entries (int): Entries kept before the least recently used are evicted.
+    """
+
+    def __init__(self, namespace, ttl=None, max_entries=10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+
+    def get_entry(self, key):
+        """
+        Returns (value, expires_at) for a live entry, or None.
+        """
+        now = time.time()
+        with _connection() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, json.dumps(key))
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                return None
+            if now - row[2] > TOUCH_INTERVAL:
+                conn.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                             (now, self.namespace, json.dumps(key)))
+                conn.commit()
+        return json.loads(row[0]), row[1]
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        now = time.time()
+        with _connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, json.dumps(key), json.dumps(value), now + ttl if ttl is not None else None, now)
+            )
+            conn.commit()
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def pop(self, key, default=None):
+        value = self.get(key, _MISSING)
+        with _connection() as conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, json.dumps(key)))
+            conn.commit()
+        return default if value is _MISSING else value
+
+    def clear(self):
+        with _connection() as conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+
+    def evict(self):
+        """
+        Deletes expired entries, then the least recently used ones beyond max_entries.
+        """
+        with _connection() as conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at < ?", (self.namespace, time.time()))
+            conn.execute(
+                '''
+                DELETE FROM cache WHERE namespace = ? AND key IN (
+                    SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                ''',
+                (self.namespace, self.namespace, self.max_entries)
+            )
+            conn.commit()
+
+
+class TieredCache:
+    """
+    An in-process LRUCache in front of a SharedCache: hot entries are served from memory, and
+    a miss there is answered by whichever worker already fetched the value. Has the same
+    get/set/pop/clear interface as LRUCache, plus aget and set_later for use on the event loop.
+    If the shared file cannot be used, the cache carries on with the local tier only.
+
+    Args:
+        namespace (str): Shared cache namespace, also used to label the cache metrics.
+        maxsize (int): Entries kept in this process's memory.
+        ttl (float): Seconds an entry stays valid in both tiers, or None.
+        shared_max_entries (int): Entries kept in the shared cache.
+    """
+
+    def __init__(self, namespace, maxsize=1024, ttl=None, shared_max_entries=10000):
+        self.namespace = namespace
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared = SharedCache(namespace, ttl=ttl, max_entries=shared_max_entries) if SHARED_CACHE_ENABLED else None
+
+    def _get_shared(self, key, default):
+        try:
+            entry = self.shared.get_entry(key)
+        except sqlite3.Error as e:
+            log.warning("Shared cache read failed: %s", e)
+            entry = None
+        metrics.cache_result(f"{self.namespace}_shared", entry is not None)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        # keep the local copy no longer than the shared one
+        self.local.set(key, value, ttl=expires_at - time.time() if expires_at is not None else None)
+        return value
+
+    def _set_shared(self, key, value, ttl):
+        try:
+            self.shared.set(key, value, ttl)
+        except sqlite3.Error as e:
+            log.warning("Shared cache write failed: %s", e)
+
+    def _set_local(self, key, value, ttl):
+        if ttl is _MISSING:
+            self.local.set(key, value)
+        else:
+            self.local.set(key, value, ttl)
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING or self.shared is None:
+            return default if value is _MISSING else value
+        return self._get_shared(key, default)
+
+    async def aget(self, key, default=None):
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING or self.shared is None:
+            return default if value is _MISSING else value
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self._get_shared, key, default)
+
+    def set(self, key, value, ttl=_MISSING):
+        self._set_local(key, value, ttl)
+        if self.shared is not None:
+            self._set_shared(key, value, ttl)
+
+    def set_later(self, key, value, ttl=_MISSING):
+        """
+        Like set, but the shared copy is written on a background thread, so callers on the
+        event loop don't wait for it; this process sees the value at once.
+        """
+        self._set_local(key, value, ttl)
+        if self.shared is not None:
+            _executor.submit(self._set_shared, key, value, ttl)
+
+    def pop(self, key, default=None):
+        value = self.local.pop(key, _MISSING)
+        if self.shared is not None:
+            shared_value = self.shared.pop(key, _MISSING)
+            value = shared_value if value is _MISSING else value
+        return default if value is _MISSING else value
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def __len__(self):
+        return len(self.local)
+
+
+def _try_lock(name, owner, lease):
+    now = time.time()
+    with _connection() as conn:
+        # take the lock if it is free or its holder's lease ran out (e.g. the worker died)
+        cursor = conn.execute(
+            '''
+            INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE locks.expires_at < ?
+            ''',
+            (name, owner, now + lease, now)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+
+@contextmanager
+def lock(name, lease=60, timeout=30, poll_interval=0.05):
+    """
+    Cross-process lock, held for at most lease seconds.
+
+    Waits up to timeout seconds for the lock and yields whether it was acquired, so a caller
+    that gives up waiting (or can't reach the cache file) can decide to go ahead anyway.
+    Without the shared cache, yields True.
+    """
+    if not SHARED_CACHE_ENABLED:
+        yield True
+        return
+    owner = f"{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex}"
+    deadline = time.monotonic() + timeout
+    try:
+        acquired = _try_lock(name, owner, lease)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            acquired = _try_lock(name, owner, lease)
+    except sqlite3.Error as e:
+        log.warning("Could not take shared lock %s: %s", name, e)
+        acquired = False
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            # if this fails, the lease runs out by itself
+            try:
+                with _connection() as conn:
+                    conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+                    conn.commit()
+            except sqlite3.Error as e:
+                log.warning("Could not release shared lock %s: %s", name, e)
@@ -0,0 +1,52 @@
+# Coalesces identical concurrent async calls into one in-flight computation
+import asyncio
+import weakref
+
+import metrics
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call per key between concurrent callers on the same event loop.
+
+    The first caller for a key starts the work; callers arriving while it runs wait for the
+    same result (or exception) instead of repeating it. Nothing is kept once the call
+    finishes, so this only removes duplicate work in flight; caching is left to the caller.
+
+    Args:
+        name (str): Label used for the coalescing counters on /metrics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # event loop -> {key: _Call}; the ingest worker runs its own loop in another thread
+        self._calls = weakref.WeakKeyDictionary()
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Returns the result of `await fn(*args, **kwargs)`, shared with concurrent callers of the same key.
+        """
+        calls = self._calls.setdefault(asyncio.get_running_loop(), {})
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = _Call(asyncio.ensure_future(fn(*args, **kwargs)))
+            call.task.add_done_callback(lambda task: calls.pop(key, None) if calls.get(key) is call else None)
+            metrics.count("singleflight_calls_total", flight=self.name, role="leader")
+        else:
+            metrics.count("singleflight_calls_total", flight=self.name, role="shared")
+
+        call.waiters += 1
+        try:
+            # a waiter that is cancelled (e.g. its client went away) must not cancel the others
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # nobody is left to use the result
+                call.task.cancel()
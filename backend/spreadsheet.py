@@ -1,11 +1,35 @@
 # parse spreadsheet data, create classes from the data, and pass classes to the server (stores)
-import gspread
-from google.oauth2.service_account import Credentials
 from service import Service
-import math
+from geo import PointSet
+from dedup import normalize_name
+from fulltext import TextIndex, rank_matches
 import hashlib
 import map
+from database import create_table, record_changes
 import time
+import json
+import os
+import threading
+import logging
+import sqlite3
+import metrics
+import clients
+import sharedcache
+import geocache
+
+log = logging.getLogger(__name__)
+
+# The shared Google Sheet that partner organizations fill in, and the service account used to read it
+SHEET_NAME = 'UrbanRefugeAidServices'
+SHEET_KEY_PATH = 'balmy-virtue-440518-c9-1dbeaecb35aa.json'
+# How long a spreadsheet snapshot is served before it is refreshed in the background (seconds)
+SHEET_CACHE_TTL = float(os.environ.get("SHEET_CACHE_TTL", 300))
+# How long to wait before retrying a sheet that could not be loaded at all (seconds)
+SHEET_RETRY_DELAY = 30
+# Longest a worker waits for another worker's sheet download before downloading it itself (seconds)
+SHEET_LOCK_TIMEOUT = float(os.environ.get("SHEET_LOCK_TIMEOUT", 60))
+# Changes to the sheet's services are recorded under this kind for /changes
+SHEET_CHANGE_KIND = "sheet"
 
 
 def hash_organization_name(name):
@@ -22,6 +46,8 @@ def filtering_service_type(service_list, service_types):
     Returns:
         filtered_list: A list of Service objects that match the service type.
     """
+    if isinstance(service_types, str):
+        service_types = [service_types]
     filtered_list = []
 
     for service in service_list:
@@ -31,149 +57,346 @@ def filtering_service_type(service_list, service_types):
     return filtered_list
 
 
-def fetch_and_process_spreadsheet_data(sheet_name, json_key_path, lat, lng, radius, service_types):
+def hash_row(row):
     """
-    Parses spreadsheet data, creates Service objects, and returns a list of Service instances.
+    Returns a stable hash of a sheet row, used to detect rows that changed between refreshes.
+    """
+    return hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
 
-    Args:
-        sheet_name (str): The name of the Google Sheet to open.
-        json_key_path (str): Path to the service account JSON key file.
-        service_type (str): A list of service types to filter by.
+
+def parse_row(row):
+    """
+    Builds a Service object from one spreadsheet row, geocoding each of its addresses.
 
     Returns:
-        list: A list of Service objects created from the spreadsheet data.
+        tuple: (Service, False if an address could not be geocoded for now, e.g. a quota or
+            network error, rather than having no results)
     """
-    # timing
-    start = time.time()
-    # Define the scope
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive"
-    ]
-
-    # Load service account credentials with defined scopes
-    creds = Credentials.from_service_account_file(json_key_path, scopes=scopes)
-
-    # Authorize the client and open the spreadsheet
-    client = gspread.authorize(creds)
-    
-    try:
-        spreadsheet = client.open(sheet_name)
-        sheet = spreadsheet.sheet1  # Access the first worksheet
-        data = sheet.get_all_records()  # Retrieve all data from the sheet
-    #print data keys
-        print(data[0].keys())
-
-    except Exception as e:
-        print("An error occurred:", e)
-        return []
-
-    # Process data and create Service instances
-    services = []
-    # index backwards, don't add if the name is already in the services list
-    for row in reversed(data):
-        if row["Name of Organization"] in [service.name for service in services]:
-            continue
-        address_list = row["Address"].split(";")
-        coordinate_list = []
-        for address in address_list:
-            if len(address) > 3:
-                coordinates = map.get_coordinates(address)
+    address_list = row["Address"].split(";")
+    coordinate_list = []
+    geocoded = True
+    for address in address_list:
+        if len(address) > 3:
+            coordinates = map.get_coordinates(address)
+            if coordinates is not None:
                 coordinate_list.append(coordinates)
-        
-        org_name = row["Name of Organization"]
-        unique_id = hash_organization_name(org_name)
-
-        service = Service(
-            ID=unique_id, 
-            name=org_name,
-            servicetype=row["Service Type"],
-            extrafilters=row["Extra Filters"],
-            demographic=row["Who are these services for? (refugees, asylees, TPS, parolees, any status, etc.)"],
-            website=row["Website"],
-            summary=row["Summary of Services"],
-            address=address_list,
-            coordinates=coordinate_list,
-            neighborhoods=row["Neighborhood"],
-            hours=row["Hours"],
-            phone=row["Phone Number (for public to contact)"],
-            languages=row["Services offered in these languages"],
-            googlelink=False,
-            source="Urban Refuge Aid"
-        )
-        services.append(service)
-
-    services_lists = filter_by_distance(services, lat, lng, radius)
-    filtered_list = filtering_service_type(services_lists, service_types)
-    print("Time taken: ", time.time() - start)
-    return filtered_list
-
-
-def filter_by_distance(services, lat, lng, radius):
-    filtered_services = []
-
-    for service in services:
-        print(service.coordinates)
-
-        # Assuming coordinates is a list of tuples (lat, lng)
-        for coordinates in service.coordinates:
-            # Unpack the coordinates tuple
-            service_lat, service_lng = coordinates
-
-            if calculate_distance(lat, lng, service_lat, service_lng) <= radius:
-                filtered_services.append(service)
-                break  # Only add the service once if it meets the distance condition
+            elif not geocache.lookup(address)[0]:
+                # only definitive "no results" answers are cached; anything else is worth retrying
+                geocoded = False
+
+    org_name = row["Name of Organization"]
+    unique_id = hash_organization_name(org_name)
+
+    service = Service(
+        ID=unique_id,
+        name=org_name,
+        servicetype=row["Service Type"],
+        extrafilters=row["Extra Filters"],
+        demographic=row["Who are these services for? (refugees, asylees, TPS, parolees, any status, etc.)"],
+        website=row["Website"],
+        summary=row["Summary of Services"],
+        address=address_list,
+        coordinates=coordinate_list,
+        neighborhoods=row["Neighborhood"],
+        hours=row["Hours"],
+        phone=row["Phone Number (for public to contact)"],
+        languages=row["Services offered in these languages"],
+        googlelink=False,
+        source="Urban Refuge Aid"
+    )
+    return service, geocoded
 
-    return filtered_services
 
+class SheetSnapshot:
+    """
+    In-memory snapshot of the parsed Service list for one Google Sheet.
+
+    The first read loads the sheet synchronously; after that, reads always return the
+    current snapshot and a stale snapshot (older than ttl seconds) is refreshed on a
+    background thread. A refresh skips the download when the sheet's revision has not
+    changed, and only re-parses (and re-geocodes) rows whose content hash changed, or whose
+    addresses could not be geocoded last time.
+    The downloaded rows are shared with the other worker processes on the host, and a
+    cross-process lock lets one worker download the sheet while the others wait for its copy.
+    """
 
+    def __init__(self, sheet_name, json_key_path, ttl=SHEET_CACHE_TTL):
+        self.sheet_name = sheet_name
+        self.json_key_path = json_key_path
+        self.ttl = ttl
+        self.services = []
+        self.view = ([], PointSet([]))
+        self.fetched_at = 0.0
+        self.revision = None
+        self._rows = []  # the sheet's records as downloaded, shared with the other workers
+        self._row_services = {}  # row hash -> Service
+        self._ungeocoded = set()  # hashes of rows with addresses to geocode again on the next refresh
+        # full-text index over the current services, updated row by row on refresh
+        self.text_index = TextIndex()
+        self._client = None
+        self._spreadsheet = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        # the downloaded rows are shared by the worker processes on the host
+        self._shared = sharedcache.SharedCache("sheet", max_entries=16) if sharedcache.SHARED_CACHE_ENABLED else None
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def get(self):
+        """
+        Returns the current list of Service objects, loading or refreshing as needed.
+        """
+        if not self.fetched_at:
+            self.refresh()
+        elif self.is_stale():
+            self.refresh_async()
+        return self.services
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _open(self):
+        # the shared client is authorized once per process; reopen the sheet if it was swapped
+        client = clients.sheets_client(self.json_key_path)
+        if self._spreadsheet is None or client is not self._client:
+            self._client = client
+            self._spreadsheet = client.open(self.sheet_name)
+        return self._spreadsheet
+
+    def refresh(self):
+        """
+        Pulls the sheet and rebuilds the snapshot. On error the previous snapshot is kept.
+
+        Returns:
+            bool: True if the snapshot is now current (downloaded, revision unchanged, or loaded
+                from another worker's copy), False if the refresh failed.
+        """
+        requested_at = time.time()
+        with self._refresh_lock:
+            # another thread finished a refresh while we were waiting for the lock
+            if self.fetched_at >= requested_at:
+                return True
+            return self._refresh()
+
+    def _refresh(self):
+        # another worker process may have downloaded the sheet recently; use its copy
+        if self._load_shared():
+            return True
+        # one worker at a time downloads the sheet; the others wait and then use its copy,
+        # or download it themselves if the holder takes too long
+        with sharedcache.lock(f"sheet:{self.sheet_name}", lease=SHEET_LOCK_TIMEOUT, timeout=SHEET_LOCK_TIMEOUT) as acquired:
+            if acquired and self._load_shared():
+                return True
+            return self._download()
+
+    def catch_up(self):
+        """
+        Loads the copy of the sheet another worker published, without downloading it, so this
+        snapshot is at least as new as the changes that worker recorded.
+        """
+        with self._refresh_lock:
+            self._load_shared()
+
+    def digests(self):
+        """
+        Returns {ID: (digest, Service)} for the current services. The digest changes whenever a
+        service's row or coordinates change, and is what the sheet's /changes entries record.
+        """
+        return {
+            str(service.ID): (hash_row([row_hash, service.coordinates]), service)
+            for row_hash, service in self._row_services.items()
+        }
+
+    def _load_shared(self):
+        if self._shared is None:
+            return False
+        try:
+            entry = self._shared.get_entry(self.sheet_name)
+        except sqlite3.Error as e:
+            log.warning("Shared sheet cache read failed: %s", e)
+            return False
+        metrics.cache_result("sheet_shared", entry is not None)
+        if entry is None:
+            return False
+        shared, expires_at = entry
+        if shared["revision"] is None or shared["revision"] != self.revision or self._ungeocoded:
+            with metrics.stage("sheet_parse"):
+                self._apply(shared["rows"])
+            self.revision = shared["revision"]
+        # stale at the same time as the shared copy, so the workers don't refresh it one after another
+        self.fetched_at = expires_at - self.ttl
+        return True
+
+    def _publish(self, data, revision):
+        if self._shared is None:
+            return
+        try:
+            self._shared.set(self.sheet_name, {"revision": revision, "rows": data}, ttl=self.ttl)
+        except sqlite3.Error as e:
+            log.warning("Shared sheet cache write failed: %s", e)
+
+    def _download(self):
+        start = time.time()
+        try:
+            with metrics.stage("sheet_download"):
+                spreadsheet = self._open()
+                revision = spreadsheet.get_lastUpdateTime() if hasattr(spreadsheet, "get_lastUpdateTime") else None
+                if revision is not None and revision == self.revision:
+                    metrics.upstream("sheet_revision")
+                    if not self._ungeocoded:
+                        self._publish(self._rows, revision)
+                        self.fetched_at = time.time()
+                        return True
+                    # the rows are the same, but some of their addresses failed to geocode; retry those
+                    data = self._rows
+                else:
+                    data = spreadsheet.sheet1.get_all_records()  # Retrieve all data from the sheet
+                    metrics.upstream("sheet")
+        except Exception as e:
+            log.error("An error occurred: %s", e)
+            metrics.upstream("sheet", "error")
+            self._spreadsheet = None
+            if not self.fetched_at:
+                # don't hammer the sheet on every request while it is unreachable
+                self.fetched_at = time.time() - self.ttl + SHEET_RETRY_DELAY
+            return False
+
+        with metrics.stage("sheet_parse"):
+            self._apply(data)
+        self._publish(data, revision)
+        self._record_changes()
+        self.revision = revision
+        self.fetched_at = time.time()
+        log.info("Sheet refreshed in %.2fs", time.time() - start)
+        return True
+
+    def _record_changes(self):
+        # only the worker that downloaded the sheet records what changed; rows keep their version
+        # while their content and coordinates are the same
+        try:
+            record_changes(SHEET_CHANGE_KIND, {ID: digest for ID, (digest, _) in self.digests().items()})
+        except sqlite3.Error as e:
+            log.warning("Could not record sheet changes: %s", e)
+
+    def _apply(self, data):
+        row_services = {}
+        services = []
+        seen_names = set()
+        ungeocoded = set()
+        reparsed = set()
+        # index backwards, don't add if the name is already in the services list
+        for row in reversed(data):
+            name = normalize_name(row["Name of Organization"])
+            if name in seen_names:
+                continue
+            seen_names.add(name)
+            row_hash = hash_row(row)
+            service = self._row_services.get(row_hash)
+            if service is None or row_hash in self._ungeocoded:
+                if service is not None:
+                    reparsed.add(row_hash)
+                service, geocoded = parse_row(row)
+                if not geocoded:
+                    ungeocoded.add(row_hash)
+            row_services[row_hash] = service
+            services.append(service)
+
+        # only rows that were added, changed or removed touch the text index
+        for row_hash in self._row_services.keys() - row_services.keys():
+            self.text_index.remove(row_hash)
+        for row_hash in (row_services.keys() - self._row_services.keys()) | reparsed:
+            self.text_index.add(row_hash, row_services[row_hash])
+
+        # swap in the new snapshot in one step so readers never see a partial list
+        self._rows = data
+        self._row_services = row_services
+        self._ungeocoded = ungeocoded
+        self.view = (services, PointSet.from_coordinates([service.coordinates for service in services]))
+        self.services = services
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(sheet_name, json_key_path):
+    """
+    Returns the process-wide SheetSnapshot for a sheet, creating it on first use.
+    """
+    with _snapshots_lock:
+        snapshot = _snapshots.get((sheet_name, json_key_path))
+        if snapshot is None:
+            snapshot = SheetSnapshot(sheet_name, json_key_path)
+            _snapshots[(sheet_name, json_key_path)] = snapshot
+        return snapshot
 
-import math
 
-def calculate_distance(lat1, lng1, lat2, lng2):
+def fetch_and_process_spreadsheet_data(sheet_name, json_key_path, lat, lng, radius, service_types, search=None):
     """
-    Calculates the distance between two geographic points using the Haversine formula.
+    Returns the Service instances from the spreadsheet snapshot that are within radius and match the service types.
 
     Args:
-        lat1 (float): Latitude of the first point.
-        lng1 (float): Longitude of the first point.
-        lat2 (float): Latitude of the second point.
-        lng2 (float): Longitude of the second point.
+        sheet_name (str): The name of the Google Sheet to open.
+        json_key_path (str): Path to the service account JSON key file.
+        service_types (list): A list of service types to filter by (a single type may be passed as a str).
+        search (str): An FTS5 query (see fulltext.fts_query); if given, only matching services are
+            returned, best match first.
 
     Returns:
-        float: Distance in meters.
+        list: A list of Service objects created from the spreadsheet data.
     """
-    # Convert latitude and longitude from degrees to radians
-    lat1_rad = math.radians(lat1)
-    lng1_rad = math.radians(lng1)
-    lat2_rad = math.radians(lat2)
-    lng2_rad = math.radians(lng2)
+    with metrics.stage("sheet_fetch"):
+        snapshot = get_snapshot(sheet_name, json_key_path)
+        metrics.cache_result("sheet", bool(snapshot.fetched_at) and not snapshot.is_stale())
+        snapshot.get()
+        # services and their points are swapped together, so read them as one pair
+        services, points = snapshot.view
+        services_lists = filter_by_distance(services, lat, lng, radius, points)
+        filtered_list = filtering_service_type(services_lists, service_types)
+        if search is not None:
+            filtered_list = rank_matches(filtered_list, snapshot.text_index.search(search))
+    return filtered_list
 
-    # Haversine formula
-    dlat = lat2_rad - lat1_rad
-    dlon = lng2_rad - lng1_rad
-    a = (math.sin(dlat / 2) ** 2 +
-         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2)
-    c = 2 * math.asin(math.sqrt(a))
 
-    # Radius of the Earth in meters (mean radius)
-    radius_of_earth_meters = 6371000
-    return c * radius_of_earth_meters
+def filter_by_distance(services, lat, lng, radius, points=None):
+    """
+    Returns the services with at least one address within radius meters, nearest first.
 
+    Args:
+        services (list): A list of Service objects.
+        points (PointSet): The services' coordinates, if already built.
+    """
+    if points is None:
+        points = PointSet.from_coordinates([service.coordinates for service in services])
+    owners, _ = points.within(lat, lng, radius)
+    return [services[owner] for owner in owners]
 
 
 def main():
+    create_table()
     lat = 42.3601
     lng = -71.0589
     radius = 5000  #500m
 
     services = fetch_and_process_spreadsheet_data(
-        'UrbanRefugeAidServices',
-        'balmy-virtue-440518-c9-1dbeaecb35aa.json', lat, lng, radius, ["Food"]
+        SHEET_NAME, SHEET_KEY_PATH, lat, lng, radius, ["Food"]
     )
     #filtered_services = filter_by_distance(services, lat, lng, radius)
     for service in services:
-        print(service.__dict__)
+        print(service.to_dict())
     print("done")
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+# Local store of services synced from Google Sheets and Places by the ingestion worker
+import json
+import time
+from database import pooled_connection, get_services_in_box, index_service_text
+from geo import PointSet
+from map import remove_duplicates
+from service import Service
+
+SHEET_SOURCE = "Urban Refuge Aid"
+PLACES_SOURCE = "Google Maps API"
+
+
+def service_types_of(service):
+    return split_service_types(service.servicetype)
+
+
+def split_service_types(servicetype):
+    # Places services carry a list of categories; sheet rows carry the form's comma-separated answer
+    if isinstance(servicetype, str):
+        return [value.strip() for value in servicetype.split(",") if value.strip()]
+    return list(servicetype or [])
+
+
+def upsert_services(services, fetched_at=None):
+    """
+    Inserts or updates synced services in one transaction, together with their service
+    types, spatial and full-text index entries, and stamps them with fetched_at. Services
+    without an ID (Places results without a url) are skipped, as on the live path.
+    """
+    fetched_at = fetched_at or time.time()
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        for service in services:
+            if not service.ID:
+                continue
+            coordinates = [(float(lat), float(lng)) for lat, lng in service.coordinates or []]
+            lat, lng = coordinates[0] if coordinates else (None, None)
+            cursor.execute(
+                '''
+                INSERT INTO services (ID, name, servicetype, extrafilters, demographic, website,
+                                      summary, address, coordinates, neighborhoods, hours, phone,
+                                      languages, googlelink, source, lat, lng, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(ID) DO UPDATE SET
+                    name = excluded.name, servicetype = excluded.servicetype,
+                    extrafilters = excluded.extrafilters, demographic = excluded.demographic,
+                    website = excluded.website, summary = excluded.summary,
+                    address = excluded.address, coordinates = excluded.coordinates,
+                    neighborhoods = excluded.neighborhoods, hours = excluded.hours,
+                    phone = excluded.phone, languages = excluded.languages,
+                    googlelink = excluded.googlelink, source = excluded.source,
+                    lat = excluded.lat, lng = excluded.lng, fetched_at = excluded.fetched_at
+                ''',
+                (
+                    str(service.ID),
+                    service.name,
+                    json.dumps(service.servicetype),
+                    json.dumps(service.extrafilters),
+                    service.demographic,
+                    service.website,
+                    service.summary,
+                    json.dumps(service.address),
+                    json.dumps(coordinates),
+                    service.neighborhoods,
+                    service.hours,
+                    service.phone,
+                    json.dumps(service.languages),
+                    json.dumps(service.googlelink),
+                    service.source,
+                    lat,
+                    lng,
+                    fetched_at
+                )
+            )
+            rowid = cursor.execute("SELECT rowid FROM services WHERE ID = ?", (str(service.ID),)).fetchone()[0]
+
+            cursor.execute("DELETE FROM service_types WHERE service_id = ?", (str(service.ID),))
+            cursor.executemany(
+                "INSERT OR IGNORE INTO service_types (servicetype, service_id) VALUES (?, ?)",
+                [(servicetype, str(service.ID)) for servicetype in service_types_of(service)]
+            )
+
+            # index the box around all of a service's addresses; the exact check happens on read
+            cursor.execute("DELETE FROM services_rtree WHERE id = ?", (rowid,))
+            if coordinates:
+                lats, lngs = zip(*coordinates)
+                cursor.execute(
+                    "INSERT INTO services_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                    (rowid, min(lats), max(lats), min(lngs), max(lngs))
+                )
+            index_service_text(cursor, rowid, service)
+        conn.commit()
+
+
+def prune(source, fetched_before):
+    """
+    Deletes services from a source that were not seen by a sync since fetched_before.
+    """
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        stale = cursor.execute(
+            "SELECT rowid, ID FROM services WHERE source = ? AND fetched_at < ?",
+            (source, fetched_before)
+        ).fetchall()
+        cursor.executemany("DELETE FROM services_rtree WHERE id = ?", [(rowid,) for rowid, _ in stale])
+        cursor.executemany("DELETE FROM services_fts WHERE rowid = ?", [(rowid,) for rowid, _ in stale])
+        cursor.executemany("DELETE FROM service_types WHERE service_id = ?", [(service_id,) for _, service_id in stale])
+        cursor.executemany("DELETE FROM services WHERE ID = ?", [(service_id,) for _, service_id in stale])
+        conn.commit()
+    return len(stale)
+
+
+def service_from_row(row):
+    """
+    Rebuilds a Service object from a stored services row.
+    """
+    return Service(
+        ID=row["ID"],
+        name=row["name"],
+        servicetype=json.loads(row["servicetype"]) if row["servicetype"] else [],
+        extrafilters=json.loads(row["extrafilters"]) if row["extrafilters"] else None,
+        demographic=row["demographic"],
+        website=row["website"],
+        summary=row["summary"],
+        address=json.loads(row["address"]) if row["address"] else [],
+        coordinates=[tuple(point) for point in json.loads(row["coordinates"])] if row["coordinates"] else [],
+        neighborhoods=row["neighborhoods"],
+        hours=row["hours"],
+        phone=row["phone"],
+        languages=json.loads(row["languages"]) if row["languages"] else [],
+        googlelink=json.loads(row["googlelink"]) if row["googlelink"] else None,
+        source=row["source"]
+    )
+
+
+def find_services(lat, lng, radius, categories, search=None):
+    """
+    Returns the synced services of the given categories within radius meters, sheet
+    services first and Places services that duplicate them removed. With an FTS5 search
+    query, only matching services are returned, best match first.
+    """
+    rows = get_services_in_box(lat, lng, radius, categories, sources=(SHEET_SOURCE, PLACES_SOURCE), search=search)
+    services = [service_from_row(row) for row in rows]
+    points = PointSet.from_coordinates([service.coordinates for service in services])
+    owners, _ = points.within(lat, lng, radius)
+    if search is not None:
+        # rows come back in rank order; keep it instead of nearest first
+        owners.sort()
+    nearby = [services[owner] for owner in owners]
+    return remove_duplicates(
+        [service for service in nearby if service.source == SHEET_SOURCE],
+        [service for service in nearby if service.source == PLACES_SOURCE]
+    )
@@ -0,0 +1,6 @@
+# The backend modules import each other by bare name (as when run from backend/), so put
+# backend/ on the path for the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+from dedup import DEDUP_TOLERANCE_METERS, ServiceDeduper
+from geo import METERS_PER_DEGREE, haversine
+
+
+def place(lat, lng):
+    return SimpleNamespace(ID=None, name=None, coordinates=[(lat, lng)])
+
+
+def offset(lat, lng, north, east):
+    # a point the given number of meters north and east of (lat, lng)
+    return (lat + north / METERS_PER_DEGREE,
+            lng + east / (METERS_PER_DEGREE * math.cos(math.radians(lat))))
+
+
+# Boston, somewhere far north, the equator and the southern hemisphere
+@pytest.mark.parametrize("lat, lng", [(42.3601, -71.0589), (64.1466, -21.9426), (0.0001, 32.58), (-33.8688, 151.2093)])
+@pytest.mark.parametrize("north, east", [(0, 22), (0, -22), (22, 0), (-22, 0), (15, 15), (-15, 15)])
+def test_near_duplicates_along_both_axes(lat, lng, north, east):
+    # step the first point across a few cells so pairs straddle cell boundaries in both directions
+    for step in range(40):
+        base_lat, base_lng = offset(lat, lng, step * 3.7, step * 5.3)
+        other_lat, other_lng = offset(base_lat, base_lng, north, east)
+        assert haversine(base_lat, base_lng, other_lat, other_lng) <= DEDUP_TOLERANCE_METERS
+        deduper = ServiceDeduper()
+        deduper.add(place(base_lat, base_lng))
+        assert deduper.is_duplicate(place(other_lat, other_lng))
+
+
+@pytest.mark.parametrize("north, east", [(0, 30), (30, 0), (-30, 0), (0, -30)])
+def test_points_beyond_tolerance_are_kept(north, east):
+    deduper = ServiceDeduper()
+    lat, lng = 42.3601, -71.0589
+    deduper.add(place(lat, lng))
+    assert not deduper.is_duplicate(place(*offset(lat, lng, north, east)))
+
+
+def test_same_name_or_id_is_duplicate():
+    deduper = ServiceDeduper()
+    assert deduper.add_if_new(SimpleNamespace(ID="1", name="St. Mary's  Center", coordinates=[]))
+    assert not deduper.add_if_new(SimpleNamespace(ID="2", name="st marys center", coordinates=[]))
+    assert not deduper.add_if_new(SimpleNamespace(ID="1", name="Other", coordinates=[]))
@@ -0,0 +1,83 @@
+# Map tiles (/tiles/{z}/{x}/{y}): the process-wide ClusterIndex, kept in step with the stored
+# services and the sheet snapshot by updating only the services that changed. Live Places
+# results are not indexed; they are on the tiles only when ingested (SERVE_FROM_STORE).
+import json
+import os
+import threading
+import time
+from clusters import ClusterIndex
+from database import get_service_points
+from spreadsheet import get_snapshot, SHEET_NAME, SHEET_KEY_PATH
+from store import split_service_types
+import metrics
+
+# How often services.db is re-read for services written by other processes (seconds)
+TILE_SYNC_INTERVAL = float(os.environ.get("TILE_SYNC_INTERVAL", 30))
+
+# Index groups: services stored in services.db, and the sheet snapshot when it is served directly
+STORED_GROUP = "stored"
+SHEET_GROUP = "sheet"
+
+index = ClusterIndex()
+_sync_lock = threading.Lock()
+_synced_at = 0.0
+_sheet_view = None  # the snapshot view the sheet group was last synced from
+
+
+def _stored_points(sources):
+    points = {}
+    for ID, name, servicetype, source, lat, lng in get_service_points(sources):
+        categories = split_service_types(json.loads(servicetype) if servicetype else None)
+        points[str(ID)] = (name, lat, lng, categories, source)
+    return points
+
+
+def _sheet_points(services):
+    points = {}
+    for service in services:
+        if service.coordinates:
+            lat, lng = service.coordinates[0]
+            points[str(service.ID)] = (service.name, float(lat), float(lng), split_service_types(service.servicetype), service.source)
+    return points
+
+
+def sync(stored_sources=None, sheet=False):
+    """
+    Brings the index up to date (blocking). services.db is re-read at most once every
+    TILE_SYNC_INTERVAL seconds, the sheet snapshot whenever it was refreshed; either way only
+    the services that were added, changed or removed are re-clustered.
+
+    Args:
+        stored_sources (tuple): Only index stored services from these sources, if given.
+        sheet (bool): Also index the sheet snapshot.
+    """
+    global _synced_at, _sheet_view
+    # one thread syncs while the others serve the index as it is (after the first sync)
+    if not _sync_lock.acquire(blocking=not _synced_at):
+        return
+    try:
+        if not _synced_at or time.monotonic() - _synced_at > TILE_SYNC_INTERVAL:
+            with metrics.stage("tile_sync"):
+                index.sync(STORED_GROUP, _stored_points(stored_sources))
+            _synced_at = time.monotonic()
+        if sheet:
+            snapshot = get_snapshot(SHEET_NAME, SHEET_KEY_PATH)
+            snapshot.get()
+            view = snapshot.view
+            if view is not _sheet_view:
+                with metrics.stage("tile_sync"):
+                    index.sync(SHEET_GROUP, _sheet_points(view[0]))
+                _sheet_view = view
+    finally:
+        _sync_lock.release()
+
+
+def add_stored(services):
+    """
+    Adds services this process just stored (ServiceModel objects), so they show on the map
+    without waiting for the next sync.
+    """
+    for service in services:
+        if service.coordinates and len(service.coordinates) == 2:
+            index.add(STORED_GROUP, str(service.ID), service.name, float(service.coordinates[0]),
+                      float(service.coordinates[1]), service.servicetype or [], service.source)
@@ -0,0 +1,103 @@
+# Upvote write path: direct UPSERTs, or an optional write-behind buffer flushed in batches
+import atexit
+import logging
+import os
+import threading
+from database import increment_upvotes
+
+log = logging.getLogger(__name__)
+
+# Buffer upvotes in memory and write them in batches instead of one transaction per upvote
+UPVOTE_WRITE_BEHIND = os.environ.get("UPVOTE_WRITE_BEHIND", "0") == "1"
+# Seconds between flushes of buffered upvotes (at most this much is lost if the process is killed)
+UPVOTE_FLUSH_INTERVAL = float(os.environ.get("UPVOTE_FLUSH_INTERVAL", 1.0))
+
+
+class UpvoteAggregator:
+    """
+    Buffers upvote increments in memory and flushes them to the reviews table in one
+    batched transaction every interval seconds.
+
+    Pending increments are visible through pending() so reads can include them before
+    they are written. stop() flushes whatever is left.
+    """
+
+    def __init__(self, interval=UPVOTE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, review_id, count=1):
+        with self._lock:
+            self._pending[review_id] = self._pending.get(review_id, 0) + count
+
+    def pending(self, review_id):
+        with self._lock:
+            return self._pending.get(review_id, 0)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                increment_upvotes(batch)
+            except Exception as e:
+                # put the batch back so the next flush retries it
+                log.error("Upvote flush failed: %s", e)
+                with self._lock:
+                    for review_id, count in batch.items():
+                        self._pending[review_id] = self._pending.get(review_id, 0) + count
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="upvote-flush")
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+
+aggregator = UpvoteAggregator() if UPVOTE_WRITE_BEHIND else None
+if aggregator is not None:
+    # last-chance flush if the process exits without the server's shutdown hook
+    atexit.register(aggregator.flush)
+
+
+def record_upvote(review_id):
+    """Add one upvote to a review ID."""
+    if aggregator is not None:
+        aggregator.add(review_id)
+    else:
+        increment_upvotes({review_id: 1})
+
+
+def with_pending(upvotes: dict) -> dict:
+    """Add buffered, not yet written upvotes to counts read from the database."""
+    if aggregator is not None:
+        for review_id in upvotes:
+            upvotes[review_id] += aggregator.pending(review_id)
+    return upvotes
+
+
+def start_writer():
+    if aggregator is not None:
+        aggregator.start()
+
+
+def stop_writer():
+    if aggregator is not None:
+        aggregator.stop()